@@ -0,0 +1,64 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import devboard.cache as cache
+
+import fixtures
+
+
+PAYLOADS = {
+    'gerrit-detail': lambda: fixtures.gerrit_detail(1),
+    'gerrit-200-details': lambda: [fixtures.gerrit_detail(i)
+                                   for i in range(200)],
+    'bugzilla-500-bugs': lambda: fixtures.bugzilla_bugs(500),
+}
+
+
+def run(payload, serializer, compression, iterations):
+    c = cache.APICache('devboard-benchmark')
+    c.configure(serializer=serializer, compression=compression)
+    h = c.digest('{}-{}-{}'.format(payload, serializer, compression))
+    data = PAYLOADS[payload]()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        c.set(h, data)
+    store = (time.perf_counter() - start) / iterations
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        c.cache.clear()
+        c.index[h].data = None
+        c.get(h, 0, None)
+    load = (time.perf_counter() - start) / iterations
+
+    return store, load, os.path.getsize(c._path(h))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Store and load throughput of the cache formats")
+    parser.add_argument('-n', '--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    # Keep the user's cache out of the benchmark
+    os.environ['HOME'] = tempfile.mkdtemp()
+    random.seed(0)
+
+    print('{:<20} {:<8} {:<6} {:>10} {:>10} {:>10}'.format(
+        'payload', 'format', 'comp', 'store ms', 'load ms', 'bytes'))
+    for payload in PAYLOADS:
+        for serializer in sorted(cache.SERIALIZERS):
+            for compression in [None] + sorted(cache.COMPRESSORS):
+                store, load, size = run(payload, serializer, compression,
+                                        args.iterations)
+                print('{:<20} {:<8} {:<6} {:>10.2f} {:>10.2f} {:>10}'.format(
+                    payload, serializer, compression or '-',
+                    store * 1000, load * 1000, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+import collections
+import http.server
+import itertools
+import json
+import multiprocessing
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import fixtures as fixtures_module
+
+
+# A local HTTP server replaying the fixtures under /bugzilla, /changes
+# (Gerrit, at the root of the server like most Gerrit servers) and
+# /etherpad, and emulating the parts of the Trello API used by devboard
+# under /trello. Every request is delayed by latency seconds and counted.
+# The server runs in its own process (see serve()) so it doesn't weigh on
+# the measures, it is controlled through /_control.
+
+
+class TrelloState(object):
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.boards = {}
+        self.lists = {}
+        self.cards = {}
+        self.labels = {}
+
+    def new_id(self):
+        return '{:024x}'.format(next(self.ids))
+
+    def card(self, c):
+        return dict(c, labels=[self.labels[i] for i in c['idLabels']])
+
+    def board(self, board_id):
+        b = dict(self.boards[board_id])
+        b['lists'] = [li for li in self.lists.values()
+                      if li['idBoard'] == board_id]
+        b['labels'] = [label for label in self.labels.values()
+                       if label['idBoard'] == board_id]
+        b['cards'] = [self.card(c) for c in self.cards.values()
+                      if c['idBoard'] == board_id]
+        return b
+
+    def position(self, list_id, pos, exclude=None):
+        positions = [c['pos'] for c in self.cards.values()
+                     if c['idList'] == list_id and c is not exclude]
+        if pos == 'top':
+            return min(positions, default=65536.0) / 2
+        if pos == 'bottom' or pos is None:
+            return max(positions, default=0.0) + 65536.0
+        return float(pos)
+
+
+class FakeServer(object):
+    def __init__(self, fixtures, latency=0.0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.pad = ''
+        self.trello = TrelloState()
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body in one packet, no delayed ACK on keep-alive
+            # connections
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, method):
+                parts = urllib.parse.urlsplit(self.path)
+                query = urllib.parse.parse_qs(parts.query)
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    query.update(urllib.parse.parse_qs(
+                        self.rfile.read(length).decode('utf-8')))
+                if not parts.path.startswith('/_control/'):
+                    with server.lock:
+                        server.requests[method] += 1
+                    time.sleep(server.latency)
+                try:
+                    status, content_type, body = server.route(
+                        method, parts.path, query)
+                except KeyError as e:
+                    status, content_type, body = (
+                        404, 'text/plain', 'Not found: {}'.format(e))
+                if not isinstance(body, bytes):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.pad = fixtures_module.etherpad(self.url,
+                                            sorted(fixtures.changes))
+
+    def control(self, method, path, query):
+        if path == '/_control/requests':
+            with self.lock:
+                return self._json(dict(self.requests))
+        if path == '/_control/reset' and method == 'POST':
+            with self.lock:
+                self.requests.clear()
+                if query.get('trello'):
+                    self.trello = TrelloState()
+            return self._json({})
+        raise KeyError(path)
+
+    def route(self, method, path, query):
+        if path.startswith('/_control/'):
+            return self.control(method, path, query)
+        if path.startswith('/changes/'):
+            return self.gerrit(method, path, query)
+        for prefix, handler in (('/bugzilla', self.bugzilla),
+                                ('/etherpad', self.etherpad),
+                                ('/trello/1', self.trello_api)):
+            if path.startswith(prefix + '/'):
+                return handler(method, path[len(prefix):], query)
+        raise KeyError(path)
+
+    def _json(self, data, prefix=''):
+        return 200, 'application/json; charset=utf-8', prefix + json.dumps(
+            data)
+
+    def bugzilla(self, method, path, query):
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['0'])[0]) or len(self.fixtures.bugs)
+        return self._json({'bugs': self.fixtures.bugs[offset:offset + limit],
+                           'faults': []})
+
+    def gerrit(self, method, path, query):
+        m = re.match(r'/changes/(\d+)/detail$', path)
+        if m:
+            return self._json(self.fixtures.changes[int(m.group(1))],
+                              ")]}'\n")
+
+        detailed = 'DETAILED_LABELS' in query.get('o', [])
+        numbers = [int(n) for n in re.findall(
+            r'(?:^|\s|change:)(\d+)', query.get('q', [''])[0])]
+        changes = [c for n, c in sorted(self.fixtures.changes.items())
+                   if not numbers or n in numbers]
+        if not detailed:
+            changes = [dict(c, labels={k: {} for k in c['labels']},
+                            owner={'_account_id':
+                                   c['owner']['_account_id']})
+                       for c in changes]
+        start = int(query.get('S', ['0'])[0])
+        count = int(query.get('n', ['500'])[0])
+        page = [dict(c) for c in changes[start:start + count]]
+        if page and start + count < len(changes):
+            page[-1]['_more_changes'] = True
+        return self._json(page, ")]}'\n")
+
+    def etherpad(self, method, path, query):
+        return 200, 'text/plain; charset=utf-8', self.pad
+
+    def trello_api(self, method, path, query):
+        t = self.trello
+        q = {k: v[0] for k, v in query.items()}
+        path = path.rstrip('/')
+
+        if method == 'GET':
+            if path == '/members/me/boards':
+                return self._json(list(t.boards.values()))
+            m = re.match(r'/boards/(\w+)$', path)
+            if m:
+                return self._json(t.board(m.group(1)))
+
+        if method == 'POST':
+            if path == '/boards':
+                b = {'id': t.new_id(), 'name': q['name']}
+                t.boards[b['id']] = b
+                return self._json(b)
+            if path == '/labels':
+                label = {'id': t.new_id(), 'name': q['name'],
+                         'color': q.get('color'), 'idBoard': q['idBoard']}
+                t.labels[label['id']] = label
+                return self._json(label)
+            if path == '/lists':
+                li = {'id': t.new_id(), 'name': q['name'],
+                      'idBoard': q['idBoard'],
+                      'pos': float(len(t.lists) + 1)}
+                t.lists[li['id']] = li
+                return self._json(li)
+            if path == '/cards':
+                li = t.lists[q['idList']]
+                c = {'id': t.new_id(), 'name': q.get('name', ''),
+                     'desc': q.get('desc', ''), 'idList': li['id'],
+                     'idBoard': li['idBoard'],
+                     'idLabels': [i for i in q.get('idLabels', '').split(',')
+                                  if i],
+                     'pos': t.position(li['id'], q.get('pos')),
+                     'attachments': []}
+                t.cards[c['id']] = c
+                return self._json(t.card(c))
+            m = re.match(r'/cards/(\w+)/attachments$', path)
+            if m:
+                a = {'id': t.new_id(), 'name': q['name'], 'url': q['url']}
+                t.cards[m.group(1)]['attachments'].append(a)
+                return self._json(a)
+
+        if method == 'PUT':
+            m = re.match(r'/cards/(\w+)$', path)
+            if m:
+                c = t.cards[m.group(1)]
+                for k in ('name', 'desc', 'idList'):
+                    if k in q:
+                        c[k] = q[k]
+                if 'idLabels' in q:
+                    c['idLabels'] = [i for i in q['idLabels'].split(',') if i]
+                if 'pos' in q:
+                    c['pos'] = t.position(c['idList'], q['pos'], exclude=c)
+                return self._json(t.card(c))
+
+        raise KeyError(path)
+
+
+def _serve(fixtures, latency, urls):
+    server = FakeServer(fixtures, latency)
+    urls.put(server.url)
+    server.server.serve_forever()
+
+
+class Client(object):
+    # Runs a FakeServer in a child process
+    def __init__(self, fixtures, latency=0.0):
+        urls = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=_serve, args=(fixtures, latency, urls), daemon=True)
+        self.process.start()
+        self.url = urls.get(timeout=60)
+
+    def _call(self, path, data=None):
+        with urllib.request.urlopen(self.url + path, data=data) as r:
+            return json.loads(r.read().decode('utf-8'))
+
+    def requests(self):
+        return self._call('/_control/requests')
+
+    def reset(self, trello=False):
+        self._call('/_control/reset', data=b'trello=1' if trello else b'')
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
@@ -0,0 +1,129 @@
+import datetime
+import json
+import os
+import random
+
+
+# Payloads shaped like the responses of Bugzilla, Gerrit and etherpad. They
+# are generated with a fixed seed, or loaded from files recorded from real
+# servers (see load()).
+
+
+def _account(n):
+    return {'_account_id': 1000 + n % 50,
+            'name': 'Developer {}'.format(n % 50),
+            'email': 'dev{}@example.com'.format(n % 50),
+            'username': 'dev{}'.format(n % 50)}
+
+
+def gerrit_change(n, rnd=random, detailed=True):
+    account = _account(n)
+    change = {
+        'id': 'openstack%2Foctavia~master~I{:040x}'.format(n),
+        'project': 'openstack/octavia',
+        'branch': 'master' if n % 4 else 'stable/train',
+        'change_id': 'I{:040x}'.format(n),
+        'subject': 'Change number {} fixing a bug in the amphora'.format(n),
+        'status': 'NEW',
+        'created': '2020-01-01 10:00:00.000000000',
+        'updated': '2020-02-{:02d} 10:00:00.000000000'.format(n % 28 + 1),
+        'mergeable': True,
+        'insertions': n % 300,
+        'deletions': n % 100,
+        '_number': 700000 + n,
+        'owner': account if detailed else {'_account_id':
+                                           account['_account_id']},
+    }
+    if detailed:
+        change['labels'] = {
+            label: {
+                'all': [dict(_account(n + i), value=rnd.choice((-1, 0, 1)),
+                             date='2020-02-01 10:00:00.000000000')
+                        for i in range(8)],
+                'values': {'-1': 'Not good', ' 0': 'No score',
+                           '+1': 'Looks good'},
+                'default_value': 0,
+            }
+            for label in ('Code-Review', 'Verified', 'Workflow')
+        }
+        change['messages'] = [
+            {'id': '{:x}'.format(i),
+             'author': account,
+             'date': '2020-02-01 10:00:00.000000000',
+             'message': 'Patch Set {}: Code-Review+1\n\n'
+                        'Looks fine to me.'.format(i),
+             '_revision_number': i}
+            for i in range(10)]
+    else:
+        change['labels'] = {label: {}
+                            for label in ('Code-Review', 'Verified',
+                                          'Workflow')}
+    return change
+
+
+def gerrit_detail(n, rnd=random):
+    return gerrit_change(n, rnd)
+
+
+def bugzilla_bug(i, rnd=random):
+    return {
+        'id': 1000000 + i,
+        'summary': 'Bug {} in the load balancer'.format(i),
+        'status': rnd.choice(('NEW', 'ASSIGNED', 'POST', 'MODIFIED')),
+        'resolution': '',
+        'priority': rnd.choice(('urgent', 'high', 'medium', 'low')),
+        'severity': rnd.choice(('urgent', 'high', 'medium', 'low')),
+        'component': ['openstack-octavia'],
+        'product': 'Red Hat OpenStack',
+        'version': '16.1',
+        'assigned_to': 'dev{}@example.com'.format(i % 20),
+        'target_milestone': '---',
+        'target_release': ['---'],
+        'last_change_time': datetime.datetime(
+            2020, 2, i % 28 + 1, i % 24).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'creation_time': '2019-01-01T10:00:00Z',
+        'cf_internal_whiteboard': 'DFG:Networking Squad:Octavia',
+        'description': 'Steps to reproduce:\n' + 'Lorem ipsum. ' * 40,
+    }
+
+
+def bugzilla_bugs(n, rnd=random):
+    return {'bugs': [bugzilla_bug(i, rnd) for i in range(n)]}
+
+
+def etherpad(base_url, numbers):
+    lines = ['Octavia priority reviews', '',
+             '* Main Priority Reviews:']
+    for n in numbers:
+        lines.append('{}/#/c/{}/ - some change'.format(base_url, n))
+    lines += ['', '* Merged:']
+    return '\n'.join(lines) + '\n'
+
+
+class Fixtures(object):
+    def __init__(self, bugs, changes):
+        # bugs: list of Bugzilla bugs, changes: map of change number to
+        # detailed Gerrit changes
+        self.bugs = bugs
+        self.changes = changes
+
+
+def generate(bugs=500, changes=200, seed=0):
+    rnd = random.Random(seed)
+    return Fixtures([bugzilla_bug(i, rnd) for i in range(bugs)],
+                    {700000 + n: gerrit_change(n, rnd)
+                     for n in range(changes)})
+
+
+def load(path):
+    # Loads recorded responses from path: bugzilla.json, the response of a
+    # /rest/bug query, and gerrit.json, the response of a /changes/ query
+    # with o=DETAILED_LABELS and o=DETAILED_ACCOUNTS
+    with open(os.path.join(path, 'bugzilla.json')) as fp:
+        bugs = json.load(fp)['bugs']
+    with open(os.path.join(path, 'gerrit.json')) as fp:
+        content = fp.read()
+    if content.startswith(")]}'"):
+        content = content.split('\n', 1)[1]
+    changes = {c['_number']: c for c in json.loads(content)}
+    return Fixtures(bugs, changes)
@@ -0,0 +1,234 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The API cache lives in $HOME, keep the user's cache out of the benchmark
+os.environ['HOME'] = tempfile.mkdtemp(prefix='devboard-benchmark-')
+
+import devboard.state as state  # noqa: E402
+import devboard.trello as trello  # noqa: E402
+import devboard.utils as utils  # noqa: E402
+from devboard.outputs.trello import TrelloOutput  # noqa: E402
+from devboard.sources.bugzilla import BugzillaItem  # noqa: E402
+from devboard.sources.bugzilla import BugzillaSource  # noqa: E402
+from devboard.sources.gerrit import GerritSource  # noqa: E402
+from devboard.sources.octavia_priority_reviews import \
+    OctaviaPriorityReviews  # noqa: E402
+
+import fakeserver  # noqa: E402
+import fixtures  # noqa: E402
+
+
+def clear_cache():
+    utils.get.cache.prune(max_age=-1)
+
+
+def drop_memory_cache():
+    # Like a new devboard process, only the cache files remain
+    c = utils.get.cache
+    with c.lock:
+        c.cache.clear()
+        c.memory_bytes = 0
+        c.index = None
+
+
+def bugzilla_source(ctx):
+    return BugzillaSource({
+        'name': 'bugzilla', 'type': 'bugzilla',
+        'url': ctx['server'].url + '/bugzilla',
+        'auth': {'api_key': 'key'},
+        'queries': [{'status': ['NEW', 'ASSIGNED']}],
+    })
+
+
+def gerrit_source(ctx, detailed_query=False):
+    return GerritSource({
+        'name': 'gerrit', 'type': 'gerrit',
+        'url': ctx['server'].url,
+        'detailed_query': detailed_query,
+        'queries': [{'filter': ['status:open']}],
+    })
+
+
+def trello_output(ctx):
+    return TrelloOutput({
+        'name': 'trello', 'type': 'trello', 'board': 'benchmark',
+        'auth': {'key': 'key', 'token': 'token'},
+    })
+
+
+def bugzilla_cold(ctx):
+    clear_cache()
+    return len(list(bugzilla_source(ctx).get()))
+
+
+def bugzilla_warm_memory(ctx):
+    return len(list(bugzilla_source(ctx).get()))
+
+
+def bugzilla_warm_disk(ctx):
+    drop_memory_cache()
+    return len(list(bugzilla_source(ctx).get()))
+
+
+def gerrit_cold(ctx):
+    clear_cache()
+    return len(gerrit_source(ctx).get())
+
+
+def gerrit_warm(ctx):
+    return len(gerrit_source(ctx).get())
+
+
+def gerrit_detailed_query_cold(ctx):
+    clear_cache()
+    return len(gerrit_source(ctx, detailed_query=True).get())
+
+
+def priority_reviews_cold(ctx):
+    clear_cache()
+    return len(OctaviaPriorityReviews({
+        'name': 'priority-reviews', 'type': 'octavia-priority-reviews',
+        'url': ctx['server'].url + '/etherpad/export/txt',
+        'username': 'benchmark',
+    }).get())
+
+
+def _trello_items(ctx, changed=0):
+    source = bugzilla_source(ctx)
+    bugs = ctx['fixtures'].bugs[:ctx['cards']]
+    return [BugzillaItem(source, **dict(
+        bug, summary=bug['summary'] + (' (updated)' if i < changed else '')))
+        for i, bug in enumerate(bugs)]
+
+
+def _trello_cycle(ctx, items):
+    output = ctx['output']
+    output.refresh()
+    output.set('bugs', items)
+    return len(items)
+
+
+def trello_first_time(ctx):
+    ctx['server'].reset(trello=True)
+    # The new fake server state reuses the ids of the previous boards
+    state.store.clear()
+    ctx['output'] = trello_output(ctx)
+    return _trello_cycle(ctx, _trello_items(ctx))
+
+
+def trello_steady_state(ctx):
+    return _trello_cycle(ctx, _trello_items(ctx))
+
+
+def trello_ten_changes(ctx):
+    return _trello_cycle(ctx, _trello_items(ctx, changed=10))
+
+
+SCENARIOS = (
+    ('bugzilla-cold', bugzilla_cold),
+    ('bugzilla-warm-memory', bugzilla_warm_memory),
+    ('bugzilla-warm-disk', bugzilla_warm_disk),
+    ('gerrit-cold', gerrit_cold),
+    ('gerrit-warm', gerrit_warm),
+    ('gerrit-detailed-query-cold', gerrit_detailed_query_cold),
+    ('priority-reviews-cold', priority_reviews_cold),
+    ('trello-first-time', trello_first_time),
+    ('trello-steady-state', trello_steady_state),
+    ('trello-ten-changes', trello_ten_changes),
+)
+
+
+def run(name, func, ctx, trace_memory):
+    server = ctx['server']
+    server.reset()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    items = func(ctx)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    requests = server.requests()
+    return {
+        'scenario': name,
+        'items': items,
+        'seconds': elapsed,
+        'requests': sum(requests.values()),
+        'requests_by_method': requests,
+        'peak_memory': peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay Bugzilla, Gerrit, etherpad and Trello responses "
+                    "from a local server and measure the sync path")
+    parser.add_argument('--latency', type=float, default=20,
+                        help='Latency of each request, in milliseconds')
+    parser.add_argument('--bugs', type=int, default=500)
+    parser.add_argument('--changes', type=int, default=200)
+    parser.add_argument('--cards', type=int, default=200,
+                        help='Number of cards of the Trello scenarios')
+    parser.add_argument('--fixtures', metavar='dir',
+                        help='Load recorded responses from dir instead of '
+                             'generating them (see fixtures.load())')
+    parser.add_argument('--no-memory', dest='trace_memory',
+                        action='store_false',
+                        help='Do not trace the memory allocations of '
+                             'devboard, tracing slows down the scenarios')
+    parser.add_argument('--json', metavar='file',
+                        help='Write the results to file')
+    parser.add_argument('scenarios', nargs='*',
+                        help='Scenarios to run (default: all), in order')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.fixtures:
+        data = fixtures.load(args.fixtures)
+    else:
+        data = fixtures.generate(bugs=args.bugs, changes=args.changes)
+
+    server = fakeserver.Client(data, latency=args.latency / 1000)
+    trello.Trello.base_url = server.url + '/trello'
+    # The fake server has no rate limit
+    trello.RATE_LIMIT = (1000000, 1)
+
+    ctx = {'server': server, 'fixtures': data, 'cards': args.cards}
+    names = args.scenarios or [name for name, _ in SCENARIOS]
+    scenarios = dict(SCENARIOS)
+    unknown = set(names) - set(scenarios)
+    if unknown:
+        parser.error("Unknown scenarios: {}".format(', '.join(unknown)))
+
+    print('{:<28} {:>6} {:>9} {:>9} {:>11}'.format(
+        'scenario', 'items', 'seconds', 'requests', 'peak KiB'))
+    results = []
+    try:
+        for name in names:
+            r = run(name, scenarios[name], ctx, args.trace_memory)
+            results.append(r)
+            print('{:<28} {:>6} {:>9.3f} {:>9} {:>11}'.format(
+                name, r['items'], r['seconds'], r['requests'],
+                r['peak_memory'] // 1024
+                if r['peak_memory'] is not None else '-'))
+            sys.stdout.flush()
+    finally:
+        utils.close()
+        server.stop()
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,558 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+
+import devboard.metrics as metrics
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+LOG = logging.getLogger(__name__)
+
+
+# Returned by the cached function when the server answered that the stored
+# response is still valid (HTTP 304)
+NOT_MODIFIED = object()
+
+# Version of the header line of the cache files. Files without a version
+# header contain the validators only and a JSON body, files without header
+# were written by the first versions of devboard.
+FORMAT_VERSION = 2
+
+
+class JSONSerializer(object):
+    name = 'json'
+
+    def dumps(self, data):
+        return json.dumps(data).encode('utf-8')
+
+    def loads(self, content):
+        return json.loads(content)
+
+
+class PickleSerializer(object):
+    # The cache directory belongs to the user, its files are trusted
+    name = 'pickle'
+    protocol = min(5, pickle.HIGHEST_PROTOCOL)
+
+    def dumps(self, data):
+        return pickle.dumps(data, protocol=self.protocol)
+
+    def loads(self, content):
+        return pickle.loads(content)
+
+
+class MsgpackSerializer(object):
+    name = 'msgpack'
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, content):
+        return msgpack.unpackb(content, raw=False)
+
+
+SERIALIZERS = {
+    s.name: s()
+    for s in (JSONSerializer, PickleSerializer, MsgpackSerializer)
+    if s is not MsgpackSerializer or msgpack is not None
+}
+
+COMPRESSORS = {
+    'zlib': (lambda c: zlib.compress(c, 1), zlib.decompress),
+}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = (zstandard.ZstdCompressor().compress,
+                           zstandard.ZstdDecompressor().decompress)
+
+
+def _header(validators, fmt='json', compression=None):
+    return json.dumps({
+        'version': FORMAT_VERSION,
+        'format': fmt,
+        'compression': compression,
+        'validators': validators,
+    }).encode('utf-8') + b'\n'
+
+
+def _parse_header(line):
+    # Returns (validators, format, compression) of a header line
+    header = json.loads(line)
+    if 'version' not in header:
+        return header, 'json', None
+    if header['version'] > FORMAT_VERSION:
+        raise ValueError("Unsupported cache format version {}".format(
+            header['version']))
+    if header['format'] not in SERIALIZERS:
+        raise ValueError("Unsupported cache format {}".format(
+            header['format']))
+    if (header['compression'] is not None and
+            header['compression'] not in COMPRESSORS):
+        raise ValueError("Unsupported cache compression {}".format(
+            header['compression']))
+    return header['validators'], header['format'], header['compression']
+
+
+def _loads(body, fmt, compression):
+    # Returns the data and the size of the uncompressed body
+    if compression is not None:
+        body = COMPRESSORS[compression][1](body)
+    return SERIALIZERS[fmt].loads(body), len(body)
+
+
+class CacheEntry(object):
+    # size is the size of the file, memory_size the size of the uncompressed
+    # entry, an estimate of the memory used by its data
+    __slots__ = ('mtime', 'size', 'memory_size', 'data', 'validators')
+
+    def __init__(self, mtime, size, data=None, validators=None):
+        self.mtime = mtime
+        self.size = size
+        self.memory_size = 0
+        self.data = data
+        self.validators = validators
+
+    def fresh(self, ttl, not_before, now):
+        if not_before:
+            ref = time.mktime(not_before.timetuple())
+            if self.mtime < ref:
+                return False
+        return ttl == 0 or self.mtime + ttl >= now
+
+
+class CacheWriter(object):
+    # Writes an entry to a temporary file, which is renamed when the entry
+    # is complete, so a reader or a crash never sees a truncated entry
+    def __init__(self, cache, h, validators, fmt='json', compression=None):
+        self.cache = cache
+        self.h = h
+        self.validators = validators or {}
+
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.cache_dir, prefix='.',
+                                             suffix='.tmp')
+        self.fp = os.fdopen(fd, 'wb')
+        self.size = 0
+        self.write(_header(self.validators, fmt, compression))
+
+    def write(self, content):
+        self.fp.write(content)
+        self.size += len(content)
+
+    def commit(self, data=None, memory_size=None):
+        # memory_size is the uncompressed size of the entry, the size of the
+        # file by default
+        try:
+            self.fp.close()
+            os.replace(self.tmp_path, self.cache._path(self.h))
+        except OSError:
+            self.abort()
+            raise
+        if memory_size is None:
+            memory_size = self.size
+        return self.cache._add(self.h, self.size, self.validators, data,
+                               memory_size)
+
+    def abort(self):
+        self.fp.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class APICache(object):
+    # Two tiers: decoded responses are kept in a bounded in-memory LRU, on
+    # top of one file per response in ~/.cache/<namespace>. The metadata of
+    # the files (mtime and size) is indexed in memory, so lookups don't hit
+    # the filesystem unless the response has to be decoded.
+    # Data returned by get() is shared between callers, it must not be
+    # modified.
+    # Each file contains a JSON header line with the format version, the
+    # serializer, the compression and the validators of the response (ETag
+    # and Last-Modified), followed by the response. Responses are stored
+    # with the configured serializer (json, pickle or msgpack) and
+    # compression (zlib or zstd). JSON responses streamed from the server
+    # are stored as received.
+    # Expired entries are revalidated with a conditional request, on
+    # NOT_MODIFIED the stored response is reused and its mtime refreshed.
+    # The size of the cache directory is capped, when a write exceeds
+    # disk_entries or disk_bytes, the least recently written files are
+    # removed until the cache is back under prune_ratio of the limits.
+    default_settings = {
+        'memory_entries': 1024,
+        'memory_bytes': 64 * 1024 * 1024,
+        'disk_entries': 20000,
+        'disk_bytes': 512 * 1024 * 1024,
+        'prune_ratio': 0.9,
+        'serializer': 'json',
+        'compression': None,
+        # JSON responses larger than stream_bytes are parsed from the file
+        # as they are read, and not kept decoded in memory
+        'stream_bytes': 1024 * 1024,
+    }
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.settings = dict(self.default_settings)
+
+        self.cache = collections.OrderedDict()
+        self.memory_bytes = 0
+        self.index = None
+        self.disk_bytes = 0
+        self.lock = threading.RLock()
+        self.counters = collections.Counter()
+
+        self.cache_dir = os.path.join(
+                os.environ['HOME'], '.cache',
+                namespace)
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def configure(self, **settings):
+        if settings.get('serializer', 'json') not in SERIALIZERS:
+            raise ValueError("Unknown or unavailable cache serializer "
+                             "{}".format(settings['serializer']))
+        if settings.get('compression') not in (None,) + tuple(COMPRESSORS):
+            raise ValueError("Unknown or unavailable cache compression "
+                             "{}".format(settings['compression']))
+        with self.lock:
+            self.settings.update(settings)
+            self._shrink()
+
+    def _path(self, h):
+        return f'{self.cache_dir}/{h}.cache'
+
+    def _load_index(self):
+        if self.index is not None:
+            return
+        self.index = {}
+        self.disk_bytes = 0
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                if e.name.endswith('.cache') and e.is_file():
+                    s = e.stat()
+                    self.index[e.name[:-6]] = CacheEntry(s.st_mtime,
+                                                         s.st_size)
+                    self.disk_bytes += s.st_size
+
+    def _over_limits(self, ratio=1.0):
+        return (len(self.index) > self.settings['disk_entries'] * ratio or
+                self.disk_bytes > self.settings['disk_bytes'] * ratio)
+
+    def _remove(self, h):
+        entry = self.index.pop(h)
+        self.disk_bytes -= entry.size
+        if self.cache.pop(h, None) is not None:
+            self.memory_bytes -= entry.memory_size
+        try:
+            os.unlink(self._path(h))
+        except FileNotFoundError:
+            pass
+
+    def _shrink(self):
+        while self.cache and (
+                len(self.cache) > self.settings['memory_entries'] or
+                self.memory_bytes > self.settings['memory_bytes']):
+            _, entry = self.cache.popitem(last=False)
+            self.memory_bytes -= entry.memory_size
+            entry.data = None
+            self.counters['evictions'] += 1
+
+    def _remember(self, h, entry, data, memory_size):
+        entry.data = data
+        if h in self.cache:
+            self.memory_bytes -= self.cache[h].memory_size
+        entry.memory_size = memory_size
+        self.cache[h] = entry
+        self.memory_bytes += memory_size
+        self._shrink()
+
+    def _read(self, h):
+        with metrics.timer('devboard_stage_seconds', stage='cache_read'):
+            return self._read_file(h)
+
+    def _read_file(self, h):
+        with open(self._path(h), 'rb') as fp:
+            content = fp.read()
+        header, sep, body = content.partition(b'\n')
+        if not sep:
+            # Entry written by a previous version of devboard, no header
+            return {}, json.loads(header), len(header)
+        validators, fmt, compression = _parse_header(header)
+        return (validators,) + _loads(body, fmt, compression)
+
+    def open(self, h, ttl, not_before):
+        # Returns (data, None) if the decoded entry is in memory, or
+        # (None, fp) with fp a file object on the JSON response, or
+        # (None, None) if there is no valid entry. Lets JSON responses larger
+        # than stream_bytes be parsed from the file without being decoded at
+        # once, other entries are decoded and kept in memory.
+        now = time.time()
+        with self.lock:
+            self._load_index()
+            entry = self.index.get(h)
+            if entry is None or not entry.fresh(ttl, not_before, now):
+                self.counters['misses'] += 1
+                return None, None
+            if entry.data is not None:
+                self.cache.move_to_end(h)
+                self.counters['hits'] += 1
+                return entry.data, None
+
+        try:
+            fp = open(self._path(h), 'rb')
+        except OSError:
+            with self.lock:
+                self.counters['misses'] += 1
+            return None, None
+
+        try:
+            header = fp.readline()
+            fmt, compression = 'json', None
+            if header.endswith(b'\n'):
+                _, fmt, compression = _parse_header(header)
+            else:
+                fp.seek(0)
+            if (fmt != 'json' or compression is not None or
+                    entry.size <= self.settings['stream_bytes']):
+                with fp:
+                    data, memory_size = _loads(fp.read(), fmt, compression)
+                with self.lock:
+                    self.counters['disk_hits'] += 1
+                    if self.index.get(h) is entry:
+                        self._remember(h, entry, data, memory_size)
+                return data, None
+        except (OSError, ValueError) as e:
+            fp.close()
+            LOG.warning(f'Cannot read cache entry {h}: {e}')
+            with self.lock:
+                self.counters['misses'] += 1
+            return None, None
+
+        with self.lock:
+            self.counters['disk_hits'] += 1
+        return None, fp
+
+    def get(self, h, ttl, not_before):
+        now = time.time()
+        with self.lock:
+            self._load_index()
+            entry = self.index.get(h)
+            if entry is None or not entry.fresh(ttl, not_before, now):
+                self.counters['misses'] += 1
+                return None
+            if entry.data is not None:
+                self.cache.move_to_end(h)
+                self.counters['hits'] += 1
+                return entry.data
+
+        try:
+            validators, data, memory_size = self._read(h)
+        except (OSError, ValueError) as e:
+            LOG.warning(f'Cannot read cache entry {h}: {e}')
+            with self.lock:
+                self.counters['misses'] += 1
+            return None
+
+        with self.lock:
+            self.counters['disk_hits'] += 1
+            if self.index.get(h) is entry:
+                entry.validators = validators
+                self._remember(h, entry, data, memory_size)
+        return data
+
+    def validators(self, h):
+        with self.lock:
+            self._load_index()
+            entry = self.index.get(h)
+            if entry is None:
+                return None
+            if entry.validators is not None:
+                return entry.validators
+
+        # Only the header line is read, the body is not decoded
+        try:
+            with open(self._path(h), 'rb') as fp:
+                header = fp.readline()
+            validators = {}
+            if header.endswith(b'\n'):
+                validators, _, _ = _parse_header(header)
+        except (OSError, ValueError):
+            return None
+        entry.validators = validators
+        return validators
+
+    def touch(self, h):
+        # The stored response is still valid, reset its age
+        with self.lock:
+            entry = self.index.get(h)
+        if entry is None:
+            return False
+
+        now = time.time()
+        try:
+            os.utime(self._path(h), (now, now))
+        except OSError:
+            return False
+
+        with self.lock:
+            self.counters['revalidated'] += 1
+            entry.mtime = now
+        return True
+
+    def refresh(self, h):
+        if not self.touch(h):
+            return None
+
+        with self.lock:
+            entry = self.index.get(h)
+            if entry is not None and entry.data is not None:
+                return entry.data
+        try:
+            _, data, memory_size = self._read(h)
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            if self.index.get(h) is entry:
+                self._remember(h, entry, data, memory_size)
+        return data
+
+    def writer(self, h, validators=None, fmt='json', compression=None):
+        return CacheWriter(self, h, validators, fmt, compression)
+
+    def set(self, h, data, validators=None, raw=None):
+        # raw is the JSON encoded data when it is already available, it is
+        # stored as is when the cache uses the json serializer
+        fmt = self.settings['serializer']
+        compression = self.settings['compression']
+        if raw is None or fmt != 'json':
+            raw = SERIALIZERS[fmt].dumps(data)
+        memory_size = len(raw)
+        if compression is not None:
+            raw = COMPRESSORS[compression][0](raw)
+
+        with metrics.timer('devboard_stage_seconds', stage='cache_write'):
+            writer = self.writer(h, validators, fmt, compression)
+            try:
+                writer.write(raw)
+            except Exception:
+                writer.abort()
+                raise
+            writer.commit(data, memory_size)
+
+    def _add(self, h, size, validators, data=None, memory_size=0):
+        with self.lock:
+            self._load_index()
+            if h in self.index:
+                self.disk_bytes -= self.index[h].size
+            entry = CacheEntry(time.time(), size, validators=validators)
+            self.index[h] = entry
+            self.disk_bytes += entry.size
+            if data is not None:
+                self._remember(h, entry, data, memory_size)
+            else:
+                old = self.cache.pop(h, None)
+                if old is not None:
+                    self.memory_bytes -= old.memory_size
+
+            if self._over_limits():
+                self.prune()
+
+    def prune(self, max_age=None):
+        # Remove the entries older than max_age seconds, then the least
+        # recently written entries while the cache is over its limits.
+        now = time.time()
+        removed = 0
+        with self.lock:
+            self._load_index()
+            for h, entry in sorted(self.index.items(),
+                                   key=lambda e: e[1].mtime):
+                if (not self._over_limits(self.settings['prune_ratio']) and
+                        (max_age is None or entry.mtime + max_age >= now)):
+                    break
+                self._remove(h)
+                removed += 1
+            self.counters['pruned'] += removed
+
+        # Leftovers of interrupted writes
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                if (e.name.startswith('.') and e.name.endswith('.tmp') and
+                        e.stat().st_mtime + 3600 < now):
+                    os.unlink(e.path)
+
+        if removed:
+            LOG.debug(f'Removed {removed} entries from {self.cache_dir}')
+        return removed
+
+    def stats(self):
+        with self.lock:
+            self._load_index()
+            lookups = (self.counters['hits'] + self.counters['disk_hits'] +
+                       self.counters['misses'])
+            return {
+                'hits': self.counters['hits'],
+                'disk_hits': self.counters['disk_hits'],
+                'misses': self.counters['misses'],
+                'evictions': self.counters['evictions'],
+                'revalidated': self.counters['revalidated'],
+                'hit_ratio': ((lookups - self.counters['misses']) / lookups
+                              if lookups else 0.0),
+                'memory_entries': len(self.cache),
+                'memory_bytes': self.memory_bytes,
+                'pruned': self.counters['pruned'],
+                'disk_entries': len(self.index),
+                'disk_bytes': self.disk_bytes,
+            }
+
+    def digest(self, key):
+        m = hashlib.sha256()
+        m.update(key.encode('utf-8'))
+        return m.hexdigest()
+
+    def key(self, url, params=None):
+        return self.digest("{}#{}".format(
+            url, urllib.parse.urlencode(params or {})))
+
+    def __call__(self, func):
+        def wrapper(url, ttl=3600, not_before=None, force=False, cache=True,
+                    **kwargs):
+            if not cache:
+                r, _, _ = func(url, **kwargs)
+                return r
+
+            h = self.key(url, kwargs.get('params'))
+
+            if not force:
+                c = self.get(h, ttl, not_before)
+                if c is not None:
+                    return c
+
+            r, validators, raw = func(url, validators=self.validators(h),
+                                      **kwargs)
+            if r is NOT_MODIFIED:
+                c = self.refresh(h)
+                if c is not None:
+                    return c
+                r, validators, raw = func(url, **kwargs)
+            self.set(h, r, validators, raw=raw)
+
+            return r
+        wrapper.cache = self
+        return wrapper
@@ -1,14 +1,20 @@
 import argparse
+import asyncio
+import copy
 import logging
 import os
-import time
 import yaml
 
 import importlib
 import pkgutil
 
+import devboard.engine as engine
+import devboard.item as item
+import devboard.metrics as metrics
 import devboard.output as output
 import devboard.source as source
+import devboard.state as state
+import devboard.utils as utils
 
 
 LOG = logging.getLogger(__name__)
@@ -28,10 +34,51 @@ class App(object):
             config_file = self._config_file('config.yml')
         if not auth_file:
             auth_file = self._config_file('auth.yml')
+        self.config_file = config_file
+        self.auth_file = auth_file
 
+        self.mtimes = self._mtimes()
         self._read_config(config_file, auth_file)
         self._register_modules()
 
+    def _mtimes(self):
+        ret = []
+        for path in (self.config_file, self.auth_file):
+            try:
+                ret.append(os.stat(path).st_mtime)
+            except (OSError, TypeError):
+                ret.append(None)
+        return ret
+
+    def changed(self):
+        return self._mtimes() != self.mtimes
+
+    def reload(self, apply=None):
+        # Reads the configuration files again if they were modified, returns
+        # True when the configuration changed. A changed configuration is
+        # passed to apply(app), which raises an exception if it is invalid.
+        # An invalid configuration is ignored, the current one is kept.
+        mtimes = self._mtimes()
+        if mtimes == self.mtimes:
+            return False
+        self.mtimes = mtimes
+
+        old = (self.config, self.auths)
+        try:
+            self._read_config(self.config_file, self.auth_file)
+            if apply is not None and (self.config, self.auths) != old:
+                apply(self)
+        except (OSError, KeyError, TypeError, ValueError,
+                yaml.YAMLError) as e:
+            LOG.error("Cannot reload the configuration: {}".format(e))
+            self.config, self.auths = old
+            if apply is not None:
+                # Settings applied before the error are reverted
+                apply(self)
+            return False
+        LOG.info("Configuration reloaded")
+        return (self.config, self.auths) != old
+
     def _config_dir(self):
         yield os.getcwd()
         yield os.path.expanduser("~/.config/devboard/")
@@ -78,20 +125,151 @@ class App(object):
 
     def _read_config(self, config_file, auth_file):
         with open(config_file) as fp:
-            self.config = yaml.safe_load(fp.read())
+            config = yaml.safe_load(fp.read())
         with open(auth_file) as fp:
-            self.auths = yaml.safe_load(fp.read())['auth']
+            auths = yaml.safe_load(fp.read())['auth']
 
+        # Sources are identified by their name, outputs by their position
+        required = {'sources': ('name', 'type'), 'outputs': ('type',)}
         for t in ('sources', 'outputs'):
-            for module in self.config[t]:
+            for i, module in enumerate(config[t]):
+                missing = [k for k in required[t] if k not in module]
+                if missing:
+                    raise ValueError("Missing {} in {} #{}".format(
+                        ', '.join(missing), t, i + 1))
                 auth_name = module.get('auth')
                 if auth_name is None:
-                    auth_name = module['name']
-                auths = [a
-                         for a in self.auths
-                         if a['name'] == auth_name]
-                if auths:
-                    module['auth'] = auths[0]
+                    auth_name = module.get('name')
+                matching = [a
+                            for a in auths
+                            if a['name'] == auth_name]
+                if matching:
+                    module['auth'] = matching[0]
+
+        self.config = config
+        self.auths = auths
+
+
+# Interval between two checks of the modification time of the configuration
+# files in daemon mode, in seconds
+CONFIG_CHECK_INTERVAL = 5
+
+
+def configure(app):
+    utils.configure_http(**app.config.get('http', {}))
+    utils.get.cache.configure(**app.config.get('cache', {}))
+    state.store.configure(**app.config.get('state', {}))
+    item.configure_templates(**app.config.get('templates', {}))
+
+
+async def update_modules(app, module_type, configs, modules):
+    # configs is a list of (key, config) of sources or outputs, modules maps
+    # their key to their (config, instance). Instances are created once and
+    # kept, with their state, as long as their configuration does not
+    # change. Returns the updated mapping.
+    ret = {}
+    for k, c in configs:
+        if k in modules and modules[k][0] == c:
+            ret[k] = modules[k]
+            continue
+
+        cls = app.get_module(module_type, c['type'])
+        if not cls:
+            print("Cannot find module {}".format(c['type']))
+            continue
+        LOG.info("Creating {} {}".format(module_type, k))
+        try:
+            ret[k] = (copy.deepcopy(c), await utils.run_sync(cls, c))
+        except Exception as e:
+            LOG.error("Cannot create {} {}: {}".format(module_type, k, e))
+    return ret
+
+
+async def watch_config(app, e):
+    while True:
+        await asyncio.sleep(CONFIG_CHECK_INTERVAL)
+        if app.changed():
+            e.notify()
+
+
+async def run(app, args):
+    e = engine.Engine(workers=args.workers)
+
+    sources = {}
+    outputs = {}
+    watcher = None
+    if args.interval >= 0:
+        watcher = asyncio.ensure_future(watch_config(app, e))
+
+    try:
+        while True:
+            app.reload(configure)
+
+            output_configs = list(enumerate(app.config['outputs']))
+            if args.dry_run:
+                output_configs = [(k, dict(c, dry_run=args.dry_run))
+                                  for k, c in output_configs]
+            outputs = await update_modules(
+                app, App.OUTPUT, output_configs, outputs)
+            previous = sources
+            sources = await update_modules(
+                app, App.SOURCE,
+                [(c['name'], c) for c in app.config['sources']], sources)
+
+            if args.interval >= 0:
+                e.retain(sources)
+                for name, (c, s) in sources.items():
+                    e.schedule(name,
+                               c.get('interval', args.interval),
+                               max_interval=c.get('max_interval'),
+                               jitter=c.get('jitter', 0.1))
+                    e.watch(name, s)
+                    if name in previous and previous[name][1] is not s:
+                        # Configuration changed, refresh now
+                        e.wake(name)
+
+            due = set(e.due(sources))
+            if due:
+                if args.profile:
+                    metrics.profiler.start()
+                with metrics.timer('devboard_cycle_seconds'):
+                    await e.cycle([(name, s, c.get('timeout'))
+                                   for name, (c, s) in sources.items()
+                                   if name in due],
+                                  [o for _, o in outputs.values()])
+                if args.profile:
+                    # Only the first cycle is profiled
+                    metrics.profiler.stop(args.profile)
+                    args.profile = None
+
+                LOG.info("Cache stats: {}".format(
+                    utils.get.cache.stats()))
+                stats_file = app.config.get('metrics', {}).get('stats_file')
+                if stats_file:
+                    try:
+                        metrics.write_stats(stats_file)
+                    except OSError as exc:
+                        LOG.error("Cannot write {}: {}".format(stats_file,
+                                                               exc))
+
+            if args.interval < 0:
+                break
+
+            await e.sleep()
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        e.close()
+        await utils.async_close()
+
+
+def cache_command(cache, args):
+    if args.action == 'prune':
+        removed = cache.prune(max_age=args.max_age)
+        print("Removed {} entries".format(removed))
+
+    for key, value in cache.stats().items():
+        print("{}: {}".format(key, value))
 
 
 def main():
@@ -102,38 +280,49 @@ def main():
                         dest='config_file', type=str)
     parser.add_argument('-a', metavar='auth_file',
                         dest='auth_file', type=str)
+    parser.add_argument('-w', metavar='workers', dest='workers',
+                        type=int, default=engine.Engine.default_workers)
+    parser.add_argument('--profile', metavar='file', dest='profile',
+                        type=str,
+                        help='Profile the first refresh and write the '
+                             'statistics to file')
+    parser.add_argument('--dry-run', metavar='file', dest='dry_run',
+                        nargs='?', const='-',
+                        help='Compute the changes of the outputs without '
+                             'writing them, print them or append them as '
+                             'JSON lines to file')
+
+    subparsers = parser.add_subparsers(dest='command')
+    cache_parser = subparsers.add_parser('cache',
+                                         help='Manage the API cache')
+    cache_parser.add_argument('action', choices=('stats', 'prune'))
+    cache_parser.add_argument('--max-age', metavar='seconds',
+                              dest='max_age', type=int,
+                              help='Remove entries older than max-age')
 
     args = parser.parse_args()
 
     app = App(config_file=args.config_file,
               auth_file=args.auth_file)
 
-    outputs = []
-    for c in app.config['outputs']:
-        cls = app.get_module(App.OUTPUT, c['type'])
-        if cls:
-            o = cls(c)
-            outputs.append(o)
+    configure(app)
 
-    while True:
-        for c in app.config['sources']:
-            cls = app.get_module(App.SOURCE, c['type'])
-            if cls:
-                try:
-                    s = cls(c)
-                    items = s.get()
-
-                    for o in outputs:
-                        o.set(c['name'], items)
-                except Exception as e:
-                    LOG.error("Received exception {}".format(e))
-            else:
-                print("Cannot find module {}".format(c['type']))
-
-        if args.interval < 0:
-            break
-
-        time.sleep(args.interval)
+    if args.command == 'cache':
+        cache_command(utils.get.cache, args)
+        return
+
+    metrics.register(lambda: [('devboard_cache_' + k, {}, v)
+                              for k, v in utils.get.cache.stats().items()])
+    if 'port' in app.config.get('metrics', {}):
+        metrics.start_server(app.config['metrics']['port'],
+                             app.config['metrics'].get('address',
+                                                       '127.0.0.1'))
+
+    try:
+        asyncio.run(run(app, args))
+    finally:
+        utils.close()
+        state.store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import random
+import time
+
+import devboard.metrics as metrics
+
+
+LOG = logging.getLogger(__name__)
+
+
+class SourceTimeout(Exception):
+    pass
+
+
+class Schedule(object):
+    # Refresh times of a source in daemon mode. The interval is doubled, up
+    # to max_interval, after each refresh returning the same items as the
+    # previous one, and reset when they change. A random jitter of +/- jitter
+    # times the interval spreads the refreshes of the sources. Refreshes
+    # requested by wake() don't move the next scheduled refresh.
+    def __init__(self, interval, max_interval=None, jitter=0.1):
+        self.interval = interval
+        self.max_interval = max(max_interval or interval * 8, interval)
+        self.jitter = jitter
+
+        self.current = interval
+        self.next_run = 0
+        self.scheduled = 0
+        self.early = False
+        self.state = None
+        # Number of wake() calls, and its value when the last refresh
+        # started
+        self.wakes = 0
+        self.started = 0
+
+    def wake(self):
+        self.wakes += 1
+        self.next_run = 0
+
+    def start(self, now):
+        self.started = self.wakes
+        self.early = now < self.scheduled
+
+    def _next(self, now):
+        if self.wakes != self.started:
+            # Woken up during the refresh, which may have missed the changes
+            # that woke it up
+            self.next_run = 0
+            return
+        if not self.early:
+            self.scheduled = now + self.current * (
+                1 + random.uniform(-self.jitter, self.jitter))
+        self.next_run = self.scheduled
+
+    def update(self, items, now):
+        state = frozenset((i.unique_id, i.fingerprint) for i in items)
+        if state == self.state:
+            self.current = min(self.current * 2, self.max_interval)
+        else:
+            self.current = self.interval
+        self.state = state
+        self._next(now)
+
+    def failed(self, now):
+        self._next(now)
+
+
+class Engine(object):
+    # Runs the refresh cycles in an asyncio event loop. Sources are fetched
+    # concurrently, at most workers at a time, and the items of a source are
+    # written to the outputs as soon as they are available, while the other
+    # sources are still fetched. Calls to a same output are serialized,
+    # different outputs are written concurrently.
+    default_workers = 4
+    default_timeout = 300
+
+    def __init__(self, workers=None, timeout=None):
+        self.workers = workers or self.default_workers
+        self.timeout = timeout or self.default_timeout
+
+        self.schedules = {}
+        self.wakeup = None
+        self.watchers = {}
+        # Fetches still running after their timeout, by source name: the
+        # thread of a blocking source cannot be interrupted, the source is
+        # not refreshed again until it returns
+        self.running = {}
+
+    def schedule(self, name, interval, max_interval=None, jitter=0.1):
+        # Returns the schedule of the source name, created on first use or
+        # when its settings change
+        s = self.schedules.get(name)
+        if s is None or (s.interval, s.jitter) != (interval, jitter) or (
+                max_interval and s.max_interval != max_interval):
+            s = Schedule(interval, max_interval, jitter)
+            self.schedules[name] = s
+        return s
+
+    def retain(self, names):
+        # Forgets the schedules and stops the watchers of the sources not in
+        # names
+        for name in set(self.schedules) - set(names):
+            del self.schedules[name]
+        for name in set(self.watchers) - set(names):
+            self.watchers.pop(name)[1].cancel()
+
+    def watch(self, name, source):
+        # Runs source.watch() until the source is replaced or removed
+        if name in self.watchers:
+            if self.watchers[name][0] is source:
+                return
+            self.watchers.pop(name)[1].cancel()
+        self.watchers[name] = (source, asyncio.ensure_future(
+            self._watch(name, source)))
+
+    async def _watch(self, name, source):
+        try:
+            await source.watch(lambda: self.wake(name))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOG.error("Watcher of {} failed: {}".format(name, e))
+
+    def close(self):
+        self.retain(())
+
+    def due(self, names):
+        now = time.monotonic()
+        return [name for name in names
+                if name not in self.running and (
+                    name not in self.schedules or
+                    self.schedules[name].next_run <= now)]
+
+    def wake(self, name=None):
+        # Refreshes the source name, or all of them, without waiting for
+        # their next refresh time
+        for n, s in self.schedules.items():
+            if name is None or n == name:
+                s.wake()
+        self.notify()
+
+    def notify(self):
+        # Interrupts sleep() without refreshing any source
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def sleep(self):
+        # Waits until a source has to be refreshed or wake() is called
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        next_runs = [s.next_run for name, s in self.schedules.items()
+                     if name not in self.running]
+        if next_runs:
+            delay = min(next_runs) - time.monotonic()
+        else:
+            delay = None
+        if delay is None or delay > 0:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        self.wakeup.clear()
+
+    async def _fetch(self, name, source, timeout, slots):
+        timeout = timeout or self.timeout
+        async with slots:
+            if name in self.schedules:
+                self.schedules[name].start(time.monotonic())
+            start = time.perf_counter()
+            task = asyncio.ensure_future(source.async_get())
+            try:
+                items = await asyncio.wait_for(asyncio.shield(task), timeout)
+            except asyncio.TimeoutError:
+                LOG.warning("Source {} did not complete after {} "
+                            "seconds".format(name, timeout))
+                self.running[name] = task
+                task.add_done_callback(lambda t: self._done(name, t))
+                metrics.inc('devboard_source_errors_total', source=name)
+                raise SourceTimeout(
+                    "Timeout after {} seconds".format(timeout))
+            except Exception:
+                metrics.inc('devboard_source_errors_total', source=name)
+                raise
+            finally:
+                metrics.observe('devboard_source_fetch_seconds',
+                                time.perf_counter() - start, source=name)
+            metrics.inc('devboard_source_items_total', len(items),
+                        source=name)
+            return items
+
+    def _done(self, name, task):
+        # A fetch that timed out returned, its items are dropped
+        if self.running.get(name) is task:
+            del self.running[name]
+        if not task.cancelled() and task.exception() is not None:
+            LOG.error("Received exception from {}: {}".format(
+                name, task.exception()))
+        self.notify()
+
+    async def _set(self, o, lock, refreshed, name, items):
+        async with lock:
+            try:
+                await refreshed
+                await o.async_set(name, items)
+            except Exception as e:
+                LOG.error("Received exception {}".format(e))
+
+    async def cycle(self, sources, outputs):
+        # sources is a list of (name, source, timeout) tuples
+        slots = asyncio.Semaphore(self.workers)
+        locks = {o: asyncio.Lock() for o in outputs}
+        refreshed = {o: asyncio.ensure_future(o.async_refresh())
+                     for o in outputs}
+        writes = []
+
+        async def fetch(name, source, timeout):
+            try:
+                items = await self._fetch(name, source, timeout, slots)
+            except Exception as e:
+                LOG.error("Received exception from {}: {}".format(name, e))
+                if name in self.schedules:
+                    self.schedules[name].failed(time.monotonic())
+                return
+            if name in self.schedules:
+                self.schedules[name].update(items, time.monotonic())
+            for o in outputs:
+                writes.append(asyncio.ensure_future(
+                    self._set(o, locks[o], refreshed[o], name, items)))
+
+        await asyncio.gather(*[fetch(*s) for s in sources])
+        await asyncio.gather(*writes)
+        await asyncio.gather(*refreshed.values(), return_exceptions=True)
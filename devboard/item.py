@@ -1,7 +1,90 @@
-from jinja2 import Environment, FileSystemLoader
+import hashlib
+import json
+import os
+import sys
+import threading
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+import devboard.metrics as metrics
+
+
+# Templates are searched in the configured paths, then in the same
+# directories as the configuration files, then in the directories where
+# devboard installs its templates
+template_settings = {
+    'paths': [],
+    'auto_reload': False,
+    'bytecode_cache': True,
+}
+
+_environment = None
+_environment_lock = threading.Lock()
+_template_digests = {}
+
+
+def _template_paths():
+    yield from template_settings['paths']
+    yield os.path.join(os.getcwd(), 'templates')
+    yield os.path.expanduser('~/.config/devboard/templates')
+    yield os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'templates')
+    yield os.path.join(sys.prefix, 'templates')
+
+
+def configure_templates(**settings):
+    global _environment
+
+    with _environment_lock:
+        template_settings.update(settings)
+        _environment = None
+        _template_digests.clear()
+
+
+def environment():
+    # A single environment is shared by all the items, it keeps compiled
+    # templates in memory, and optionally on disk. Templates are only
+    # checked for changes if auto_reload is set (development).
+    global _environment
+
+    with _environment_lock:
+        if _environment is None:
+            bytecode_cache = None
+            if template_settings['bytecode_cache']:
+                cache_dir = os.path.join(os.environ['HOME'], '.cache',
+                                         'devboard', 'templates')
+                os.makedirs(cache_dir, exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+            _environment = Environment(
+                loader=FileSystemLoader([p
+                                         for p in _template_paths()
+                                         if os.path.isdir(p)]),
+                auto_reload=template_settings['auto_reload'],
+                bytecode_cache=bytecode_cache)
+        return _environment
+
+
+def template_digest(name):
+    digest = _template_digests.get(name)
+    if digest is None or template_settings['auto_reload']:
+        env = environment()
+        source, _, _ = env.loader.get_source(env, name)
+        digest = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        _template_digests[name] = digest
+    return digest
 
 
 class Item(object):
+    # Items only keep the fields of the source payload listed in fields,
+    # property_mapping maps an attribute name to its key in the payload.
+    # A field missing from the payload is not set, so it is undefined in
+    # templates. Subclasses declare their new fields in __slots__.
+    # unique_id, tags, last_update and fingerprint are computed once when
+    # the item is built.
+    __slots__ = ('source', 'unique_id', 'tags', 'last_update', 'fingerprint')
+
+    fields = ()
     property_mapping = {}
 
     label_colors = ()
@@ -9,32 +92,51 @@ class Item(object):
 
     def __init__(self, source, **kwargs):
         self.source = source
-        self.args = kwargs
+        for name in self.fields:
+            key = self.property_mapping.get(name, name)
+            if key in kwargs:
+                setattr(self, name, self._convert(name, kwargs[key]))
 
-    def __getattr__(self, name):
-        mapped_attr = self.property_mapping.get(name, name)
-        if mapped_attr in self.args:
-            return self.args[mapped_attr]
-        raise AttributeError(name)
+        self.unique_id = "{}-{}".format(self.source.unique_name, self.id)
+        self.tags = frozenset(self._tags())
+        self.last_update = self._last_update()
+        self.fingerprint = self._fingerprint()
 
     def __repr__(self):
         return '<{} {}>'.format(self.__class__.__name__, self.id)
 
-    @property
-    def content(self):
-        env = Environment(
-                loader=FileSystemLoader('templates/')
-        )
-        template = env.get_template("{}.j2".format(self.source.name))
-        return template.render(item=self, source=self.source)
+    def _convert(self, name, value):
+        return value
+
+    def _tags(self):
+        return []
+
+    def _last_update(self):
+        return None
+
+    def _fingerprint(self):
+        # Hash of everything the summary, content and tags of the item are
+        # computed from, an item with the same fingerprint as the item
+        # written to an output doesn't need to be rendered again
+        m = hashlib.sha256()
+        m.update(template_digest(self.template_name).encode('utf-8'))
+        m.update(json.dumps([self.source.config.get('url'),
+                             {name: getattr(self, name, None)
+                              for name in self.fields}],
+                            sort_keys=True, default=str).encode('utf-8'))
+        return m.hexdigest()
 
     @property
-    def unique_id(self):
-        return "{}-{}".format(self.source.unique_name, self.id)
+    def template_name(self):
+        return "{}.j2".format(self.source.name)
 
     @property
-    def tags(self):
-        return []
+    def content(self):
+        metrics.inc('devboard_items_rendered_total',
+                    source=self.source.unique_name)
+        with metrics.timer('devboard_stage_seconds', stage='render'):
+            template = environment().get_template(self.template_name)
+            return template.render(item=self, source=self.source)
 
     def label_color(self, label_name):
         for pair in self.label_colors:
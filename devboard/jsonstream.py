@@ -0,0 +1,125 @@
+import codecs
+import json
+
+
+# Prefix sent by Gerrit to prevent XSSI, it is followed by a newline
+XSSI_PREFIX = b")]}'"
+
+WHITESPACE = ' \t\n\r'
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+def skip_xssi_prefix(chunks):
+    # Removes XSSI_PREFIX and its line from the beginning of a stream of
+    # bytes
+    head = b''
+    chunks = iter(chunks)
+    for chunk in chunks:
+        head += chunk
+        if head.startswith(XSSI_PREFIX):
+            _, sep, rest = head.partition(b'\n')
+            if sep:
+                head = rest
+                break
+        elif (len(head) >= len(XSSI_PREFIX) or
+              not XSSI_PREFIX.startswith(head)):
+            break
+    if head:
+        yield head
+    yield from chunks
+
+
+class _Parser(object):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        if self.eof:
+            return False
+        for chunk in self.chunks:
+            text = self.decoder.decode(chunk)
+            if text:
+                # Drop what has already been parsed
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        self.buf = self.buf[self.pos:] + self.decoder.decode(b'', final=True)
+        self.pos = 0
+        self.eof = True
+        return False
+
+    def peek(self):
+        # Next non whitespace character, or None at the end of the stream
+        while True:
+            while (self.pos < len(self.buf) and
+                   self.buf[self.pos] in WHITESPACE):
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                return None
+
+    def expect(self, chars):
+        c = self.peek()
+        if c is None or c not in chars:
+            raise JSONStreamError("Expecting one of {!r} at {!r}".format(
+                chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def value(self):
+        # Decodes a complete JSON value, reading more data until it is
+        # complete. A value is only accepted when it is followed by another
+        # character, so numbers cut at the end of a chunk are not truncated.
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError as e:
+                if self.eof:
+                    raise JSONStreamError(str(e))
+            self._more()
+
+
+def iter_array(chunks, path=()):
+    # Yields the elements of the JSON array found at path (a list of object
+    # keys, empty for a top-level array) in a stream of bytes chunks. Only
+    # one element at a time is kept decoded in memory.
+    parser = _Parser(skip_xssi_prefix(chunks))
+
+    for key in path:
+        parser.expect('{')
+        while True:
+            if parser.peek() == '}':
+                raise JSONStreamError("Key {!r} not found".format(key))
+            k = parser.value()
+            parser.expect(':')
+            if k == key:
+                break
+            parser.value()
+            if parser.expect(',}') == '}':
+                raise JSONStreamError("Key {!r} not found".format(key))
+
+    if parser.peek() == 'n':
+        # null instead of an array
+        parser.value()
+        return
+
+    parser.expect('[')
+    if parser.peek() == ']':
+        return
+    while True:
+        yield parser.value()
+        if parser.expect(',]') == ']':
+            return
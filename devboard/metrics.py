@@ -0,0 +1,242 @@
+import bisect
+import collections
+import contextlib
+import cProfile
+import http.server
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+# Upper bounds of the buckets of the histograms, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, 120.0, 300.0)
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry(object):
+    # Counters and histograms of devboard, identified by a name and a set of
+    # labels. Gauges are read from the collectors when the metrics are
+    # exported, a collector returns a list of (name, labels, value).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.histograms = collections.defaultdict(Histogram)
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def register(self, collector):
+        self.collectors.append(collector)
+
+    def _gauges(self):
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    yield name, tuple(sorted(labels.items())), value
+            except Exception as e:
+                LOG.error("Metrics collector failed: {}".format(e))
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: (list(h.counts), h.count, h.sum)
+                          for k, h in self.histograms.items()}
+        return counters, histograms, list(self._gauges())
+
+    def to_dict(self):
+        counters, histograms, gauges = self.snapshot()
+
+        def key(name, labels):
+            if not labels:
+                return name
+            return '{}{{{}}}'.format(name, ','.join(
+                '{}={}'.format(k, v) for k, v in labels))
+
+        ret = {key(*k): v for k, v in counters.items()}
+        ret.update((key(name, labels), value)
+                   for name, labels, value in gauges)
+        for k, (counts, count, total) in histograms.items():
+            ret[key(*k)] = {
+                'count': count,
+                'sum': total,
+                'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'],
+                                    counts)),
+            }
+        return ret
+
+    def to_prometheus(self):
+        counters, histograms, gauges = self.snapshot()
+
+        def labels_str(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{{{}}}'.format(','.join(
+                '{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                 .replace('"', '\\"'))
+                for k, v in labels))
+
+        lines = []
+        typed = set()
+
+        def add(name, kind, labels, value, extra=(), suffix=''):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{}{}{} {}'.format(name, suffix,
+                                            labels_str(labels, extra),
+                                            value))
+
+        for (name, labels), value in sorted(counters.items()):
+            add(name, 'counter', labels, value)
+        for name, labels, value in sorted(gauges):
+            add(name, 'gauge', labels, value)
+        for (name, labels), (counts, count, total) in sorted(
+                histograms.items()):
+            cumulative = 0
+            for bound, n in zip(list(BUCKETS) + ['+Inf'], counts):
+                cumulative += n
+                add(name, 'histogram', labels, cumulative,
+                    extra=(('le', bound),), suffix='_bucket')
+            add(name, 'histogram', labels, total, suffix='_sum')
+            add(name, 'histogram', labels, count, suffix='_count')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+register = registry.register
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(port, address='127.0.0.1'):
+    # Serves the metrics in the Prometheus text format on /metrics
+    server = http.server.ThreadingHTTPServer((address, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    LOG.info("Serving metrics on http://{}:{}/metrics".format(address, port))
+    return server
+
+
+def write_stats(path):
+    path = os.path.expanduser(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(registry.to_dict(), fp, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+class Profiler(object):
+    # Before Python 3.12, cProfile only profiles the thread it is enabled
+    # in, so the calls run in threads (blocking sources and outputs,
+    # parallel requests) are profiled separately with wrap() and merged into
+    # the report. Since 3.12, a profiler profiles all the threads and only
+    # one can be enabled at a time.
+    per_thread = sys.version_info < (3, 12)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = False
+        self.profiles = []
+
+    def start(self):
+        with self.lock:
+            self.active = True
+            self.profiles = [cProfile.Profile()]
+        self.profiles[0].enable()
+
+    def wrap(self, func):
+        if not self.active or not self.per_thread:
+            return func
+
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                # Calls still running when the profiler stops are left out
+                with self.lock:
+                    if self.active:
+                        self.profiles.append(profile)
+        return wrapper
+
+    def stop(self, path, limit=30):
+        self.profiles[0].disable()
+        with self.lock:
+            self.active = False
+            profiles, self.profiles = self.profiles, []
+
+        # Calls that did not run any Python code have no statistics
+        stats = pstats.Stats(*[p for p in profiles if p.getstats()])
+        stats.dump_stats(path)
+
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats('cumulative').print_stats(limit)
+        LOG.info("Profile written to {}\n{}".format(path, out.getvalue()))
+
+
+profiler = Profiler()
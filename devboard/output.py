@@ -1,5 +1,22 @@
+import devboard.utils as utils
+
+
 class Output(object):
     name = 'output'
 
     def __init__(self, config):
         self.config = config
+
+    def refresh(self):
+        # Called at the beginning of each refresh cycle
+        pass
+
+    # Like sources, outputs may override the async methods, the blocking
+    # ones are run in a thread otherwise. Calls to an output are never
+    # concurrent.
+
+    async def async_refresh(self):
+        await utils.run_sync(self.refresh)
+
+    async def async_set(self, list_name, item_list):
+        await utils.run_sync(self.set, list_name, item_list)
@@ -14,18 +14,9 @@ class TrelloOutput(Output):
         if not self.board:
             self.board = self.trello.board_create(config['board'])
 
-    def set(self, list_name, item_list):
-        li = self.trello.list_get(self.board, list_name)
-        if not li:
-            li = self.trello.list_create(self.board, list_name)
-
-        item_ids = {i.unique_id for i in item_list}
-        card_ids = {c_id for c_id in self.trello.cards(li)}
+    def refresh(self):
+        self.trello.refresh(self.board)
 
-        card_ids_to_delete = card_ids - item_ids
-        for card_id in card_ids_to_delete:
-            self.trello.card_delete(li, card_id)
-
-        # Insert cards in reverse order (from oldest to newest)
-        for item in sorted(item_list, key=lambda e: e.last_update):
-            self.trello.card_set(li, item)
+    def set(self, list_name, item_list):
+        ops = self.trello.plan(self.board, list_name, item_list)
+        self.trello.apply(self.board, ops)
@@ -0,0 +1,240 @@
+import bisect
+import hashlib
+
+
+# Distance between two cards when appended at the bottom of a list
+POS_STEP = 65536.0
+
+MAX_DESC_LENGTH = 4096
+
+
+class Operation(object):
+    actions = (LIST_CREATE, LABEL_CREATE,
+               CARD_CREATE, CARD_UPDATE) = ('list_create', 'label_create',
+                                            'card_create', 'card_update')
+
+    def __init__(self, action, card=None, item=None, **params):
+        self.action = action
+        self.card = card
+        self.item = item
+        self.params = params
+
+    def __repr__(self):
+        return '<{} {} {}>'.format(
+            self.action,
+            self.card.unique_id if self.card else '',
+            ', '.join('{}={!r:.40}'.format(k, v)
+                      for k, v in sorted(self.params.items())))
+
+
+def describe(op):
+    # Serializable description of an operation, labels are reported as the
+    # labels added to and removed from the card
+    params = dict(op.params)
+    ret = {'action': op.action}
+    if op.card is not None:
+        ret['card'] = op.card.id
+        ret['unique_id'] = op.card.unique_id
+    if 'labels' in params:
+        labels = set(params.pop('labels'))
+        current = set()
+        if op.card is not None:
+            current = {label['name'] for label in op.card.labels}
+        ret['labels_added'] = sorted(labels - current)
+        ret['labels_removed'] = sorted(current - labels)
+    ret.update(params)
+    return ret
+
+
+def content_state(name, desc, label_names):
+    # Hash of the fields of a card written from an item
+    m = hashlib.sha256()
+    for value in [name, desc] + sorted(label_names):
+        m.update(value.encode('utf-8'))
+        m.update(b'\0')
+    return m.hexdigest()
+
+
+def card_state(c):
+    # Cards loaded from the state store only have the hash of their content
+    if 'desc' not in c.args:
+        return c.state
+    return content_state(c.name, c.desc,
+                         [label['name'] for label in c.labels])
+
+
+def _increasing_subsequence(seq):
+    # Indexes of a longest strictly increasing subsequence of seq
+    tails = []
+    tail_indexes = []
+    predecessors = [None] * len(seq)
+    for i, value in enumerate(seq):
+        j = bisect.bisect_left(tails, value)
+        if j == len(tails):
+            tails.append(value)
+            tail_indexes.append(i)
+        else:
+            tails[j] = value
+            tail_indexes[j] = i
+        predecessors[i] = tail_indexes[j - 1] if j else None
+
+    ret = []
+    i = tail_indexes[-1] if tail_indexes else None
+    while i is not None:
+        ret.append(i)
+        i = predecessors[i]
+    return ret[::-1]
+
+
+def positions(desired, current):
+    # desired is the list of card ids from top to bottom, current maps the
+    # ids of the cards already in the list to their position. The cards of
+    # the longest run already in the right order keep their position, new
+    # positions are returned for the other ones.
+    existing = [i for i in desired if i in current]
+    kept = {existing[i]
+            for i in _increasing_subsequence([current[i]
+                                              for i in existing])}
+
+    ret = {}
+    prev = 0.0
+    i = 0
+    while i < len(desired):
+        if desired[i] in kept:
+            prev = current[desired[i]]
+            i += 1
+            continue
+
+        j = i
+        while j < len(desired) and desired[j] not in kept:
+            j += 1
+        for n, card_id in enumerate(desired[i:j], 1):
+            if j < len(desired):
+                step = (current[desired[j]] - prev) / (j - i + 1)
+            else:
+                step = POS_STEP
+            ret[card_id] = prev + step * n
+        prev = ret[desired[j - 1]]
+        i = j
+    return ret
+
+
+def coalesce(ops):
+    # Merges the updates of a same card into its first update, so each card
+    # is written at most once
+    ret = []
+    updates = {}
+    for op in ops:
+        if op.action != Operation.CARD_UPDATE:
+            ret.append(op)
+        elif op.card.id in updates:
+            updates[op.card.id].params.update(op.params)
+        else:
+            updates[op.card.id] = Operation(op.action, card=op.card,
+                                            item=op.item, **op.params)
+            ret.append(updates[op.card.id])
+    return ret
+
+
+def plan_list(snapshot, list_name, items, done_list_name='Done',
+              pushed=None):
+    # Computes the operations that turn the list list_name of the snapshot
+    # into the list of items, newest items at the top. Cards that are not
+    # in items are moved to done_list_name. Nothing is returned when the
+    # list is already up to date.
+    # pushed maps the unique_id of the items to the fingerprint of the item
+    # and the state of the card when they were last written. When neither
+    # has changed, the item is not rendered nor compared with its card.
+    ops = []
+    if pushed is None:
+        pushed = {}
+
+    li = snapshot.lists.get(list_name)
+    if li is None:
+        ops.append(Operation(Operation.LIST_CREATE, name=list_name))
+        cards = {}
+    else:
+        cards = snapshot.cards.get(li.id, {})
+
+    # Items updated at the same time are sorted by unique_id, so their order
+    # does not depend on the order they were received in
+    items = sorted(items, key=lambda e: (e.last_update, e.unique_id),
+                   reverse=True)
+    item_ids = {item.unique_id for item in items}
+
+    def unchanged(item):
+        c = cards.get(item.unique_id)
+        return (c is not None and
+                pushed.get(item.unique_id) == (item.fingerprint,
+                                               card_state(c)))
+
+    changed_items = [item for item in items if not unchanged(item)]
+    changed_ids = {item.unique_id for item in changed_items}
+
+    new_labels = {}
+    for item in changed_items:
+        for tag in item.tags:
+            if tag not in snapshot.labels and tag not in new_labels:
+                new_labels[tag] = item.label_color(tag)
+    for name, color in sorted(new_labels.items()):
+        ops.append(Operation(Operation.LABEL_CREATE, name=name, color=color))
+
+    new_positions = positions([item.unique_id for item in items],
+                              {card_id: c.pos
+                               for card_id, c in cards.items()})
+
+    for item in items:
+        c = cards.get(item.unique_id)
+        if item.unique_id not in changed_ids:
+            if item.unique_id in new_positions:
+                ops.append(Operation(Operation.CARD_UPDATE, card=c,
+                                     pos=new_positions[item.unique_id]))
+            continue
+
+        content = item.content[:MAX_DESC_LENGTH]
+        labels = set(item.tags)
+
+        if c is None:
+            ops.append(Operation(Operation.CARD_CREATE,
+                                 item=item,
+                                 unique_id=item.unique_id,
+                                 list=list_name,
+                                 name=item.summary,
+                                 desc=content,
+                                 pos=new_positions[item.unique_id],
+                                 labels=labels))
+            continue
+
+        params = {}
+        if 'desc' not in c.args:
+            if c.state != content_state(item.summary, content,
+                                        [label['name']
+                                         for label in c.labels]):
+                params['name'] = item.summary
+                params['desc'] = content
+        else:
+            if c.name != item.summary:
+                params['name'] = item.summary
+            if c.desc != content:
+                params['desc'] = content
+        if item.unique_id in new_positions:
+            params['pos'] = new_positions[item.unique_id]
+        if {label['name'] for label in c.labels} != labels:
+            params['labels'] = labels
+        if params.keys() - {'pos'}:
+            ops.append(Operation(Operation.CARD_UPDATE, card=c, item=item,
+                                 **params))
+        else:
+            pushed[item.unique_id] = (item.fingerprint, card_state(c))
+            if params:
+                ops.append(Operation(Operation.CARD_UPDATE, card=c,
+                                     **params))
+
+    archived = [c for card_id, c in cards.items() if card_id not in item_ids]
+    if archived and done_list_name not in snapshot.lists:
+        ops.append(Operation(Operation.LIST_CREATE, name=done_list_name))
+    for c in archived:
+        ops.append(Operation(Operation.CARD_UPDATE, card=c,
+                             list=done_list_name, pos='top'))
+
+    return ops
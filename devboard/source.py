@@ -1,3 +1,6 @@
+import devboard.utils as utils
+
+
 class Source(object):
     name = 'source'
 
@@ -7,3 +10,16 @@ class Source(object):
     @property
     def unique_name(self):
         return self.config.get('name', self.name)
+
+    async def async_get(self):
+        # Sources doing their requests with the async functions of
+        # devboard.utils override async_get(), get() is run in a thread
+        # otherwise. get() may return a generator, items are collected in
+        # the thread.
+        return await utils.run_sync(lambda: list(self.get()))
+
+    async def watch(self, notify):
+        # Run while the source is in use in daemon mode. Sources notified of
+        # their changes (push mode) call notify() to be refreshed without
+        # waiting for their next refresh time.
+        pass
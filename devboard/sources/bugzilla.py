@@ -1,4 +1,6 @@
 import datetime
+import time
+import urllib.parse
 
 import devboard.utils
 from devboard.source import Source
@@ -6,9 +8,24 @@ from devboard.item import Item
 
 
 class BugzillaItem(Item):
-    property_mapping = {
-        'update_time': 'last_change_time'
-    }
+    __slots__ = fields = (
+        "id",
+        "creation_time",
+        "last_change_time",
+        "cf_internal_whiteboard",
+        "severity",
+        "priority",
+        "product",
+        "version",
+        "target_milestone",
+        "target_release",
+        "component",
+        "assigned_to",
+        "status",
+        "resolution",
+        "summary",
+        "description"
+    )
 
     label_colors = (
         ('urgent', 'purple'),
@@ -17,16 +34,14 @@ class BugzillaItem(Item):
         ('low', 'green'),
     )
 
-    @property
-    def tags(self):
+    def _tags(self):
         return {self.status,
-                "p:{}".format(self.args['priority']),
-                "s:{}".format(self.args['severity'])}
+                "p:{}".format(self.priority),
+                "s:{}".format(self.severity)}
 
-    @property
-    def last_update(self):
+    def _last_update(self):
         return datetime.datetime.strptime(
-            self.args['last_change_time'],
+            self.last_change_time,
             "%Y-%m-%dT%H:%M:%SZ")
 
 
@@ -34,41 +49,94 @@ class BugzillaSource(Source):
     name = "bugzilla"
 
     parameters = {
-        "include_fields": [
-            "id",
-            "creation_time",
-            "last_change_time",
-            "cf_internal_whiteboard",
-            "severity",
-            "priority",
-            "product",
-            "version",
-            "target_milestone",
-            "target_release",
-            "component",
-            "assigned_to",
-            "status",
-            "resolution",
-            "summary",
-            "description"
-        ],
+        "include_fields": list(BugzillaItem.fields),
     }
 
-    def get(self):
-        params = dict(self.parameters)
-        params["api_key"] = self.config['auth']['api_key']
+    def __init__(self, config):
+        super(BugzillaSource, self).__init__(config)
+
+        # In incremental mode, only the bugs changed since the previous
+        # refresh are requested and merged into the result set kept in the
+        # cache. A full query is done every full_sync_interval seconds to
+        # drop the bugs that no longer match the query.
+        self.incremental = config.get('incremental', False)
+        self.full_sync_interval = config.get('full_sync_interval', 86400)
+
+        self.page_size = config.get('page_size', 500)
+        self.workers = config.get('workers', devboard.utils.DEFAULT_WORKERS)
+
+    def _fetch(self, url, params, **kwargs):
+        # Results are requested by pages of page_size bugs, a page smaller
+        # than page_size is the last one. Bugs are decoded one at a time
+        # while the page is received.
+        offset = 0
+        while True:
+            page_params = dict(params, limit=self.page_size, offset=offset)
+            count = 0
+            for bug in devboard.utils.iter_json(url, path=('bugs',),
+                                                params=page_params,
+                                                **kwargs):
+                count += 1
+                yield bug
 
-        # TODO: handle more than one query
-        params.update(self.config['queries'][0])
+            if count < self.page_size:
+                break
+            offset += count
 
-        doc = devboard.utils.get(
-            "{}/rest/bug".format(self.config['url']),
-            params=params)
+    def _fetch_incremental(self, url, params):
+        cache = devboard.utils.get.cache
+        h = cache.digest("bugzilla-sync#{}#{}".format(
+            url, urllib.parse.urlencode(sorted(params.items()), doseq=True)))
 
-        bugs = doc['bugs']
+        now = time.time()
+        state = cache.get(h, 0, None)
+        if (state is None or not state.get('last_change_time') or
+                state['full_sync'] + self.full_sync_interval < now):
+            state = {
+                'full_sync': now,
+                'bugs': {str(bug['id']): bug
+                         for bug in self._fetch(url, params, cache=False)}
+            }
+        else:
+            # last_change_time returns the bugs changed at this time or
+            # later, bugs changed at the time of the cursor are fetched again
+            delta_params = dict(params,
+                                last_change_time=state['last_change_time'])
+            changed = {str(bug['id']): bug
+                       for bug in self._fetch(url, delta_params, cache=False)
+                       if bug != state['bugs'].get(str(bug['id']))}
+            if not changed:
+                yield from state['bugs'].values()
+                return
+
+            # state is shared with the cache, don't update it in place
+            state = dict(state, bugs=dict(state['bugs'], **changed))
+
+        state['last_change_time'] = max(
+            (bug['last_change_time'] for bug in state['bugs'].values()),
+            default=None)
+        cache.set(h, state)
+
+        yield from state['bugs'].values()
+
+    def get(self):
+        url = "{}/rest/bug".format(self.config['url'])
 
-        ret = []
-        for bug in bugs:
-            ret.append(BugzillaItem(self, **bug))
+        queries = []
+        for query in self.config['queries']:
+            params = dict(self.parameters)
+            params["api_key"] = self.config['auth']['api_key']
+            params.update(query)
+            if self.incremental:
+                queries.append(self._fetch_incremental(url, params))
+            else:
+                queries.append(self._fetch(url, params))
 
-        return ret
+        # Queries are run concurrently, bugs are turned into items as they
+        # are received, a bug matching several queries is only returned once
+        seen = set()
+        for bug in devboard.utils.parallel_chain(queries,
+                                                 workers=self.workers):
+            if bug['id'] not in seen:
+                seen.add(bug['id'])
+                yield BugzillaItem(self, **bug)
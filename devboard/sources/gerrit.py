@@ -1,15 +1,44 @@
+import asyncio
 import datetime
+import json
+import logging
+import shlex
+import threading
+import time
+import urllib.parse
 
 from devboard.source import Source
 from devboard.item import Item
 import devboard.utils
 
 
+LOG = logging.getLogger(__name__)
+
+
 class GerritItem(Item):
+    __slots__ = fields = (
+        'id',
+        '_number',
+        'change_id',
+        'summary',
+        'status',
+        'owner',
+        'project',
+        'branch',
+        'topic',
+        'mergeable',
+        'created',
+        'updated',
+        'labels',
+    )
+
     property_mapping = {
         'summary': 'subject'
     }
 
+    account_fields = ('name', 'email', 'username')
+    vote_fields = ('name', 'username', 'value')
+
     label_colors = (
         ('BC-', 'orange'),
         ('BC+', 'lime'),
@@ -17,9 +46,23 @@ class GerritItem(Item):
         ('+', 'green'),
     )
 
+    def _convert(self, name, value):
+        # Only keep the accounts and votes from the payload of the change
+        if name == 'owner':
+            return {k: v
+                    for k, v in value.items()
+                    if k in self.account_fields}
+        if name == 'labels':
+            return {label: {'all': [{k: v
+                                     for k, v in vote.items()
+                                     if k in self.vote_fields}
+                                    for vote in votes.get('all', [])]}
+                    for label, votes in value.items()}
+        return value
+
     def _label(self, label_name, shortname):
         ret = set()
-        for cr in self.args['labels'].get(label_name, {}).get('all', []):
+        for cr in self.labels.get(label_name, {}).get('all', []):
             if 'value' in cr and cr['value'] != 0:
                 ret.add("{}{}{}".format(
                     shortname,
@@ -39,20 +82,58 @@ class GerritItem(Item):
     def _backport_candidate(self):
         return self._label('Backport-Candidate', 'BC')
 
-    @property
-    def tags(self):
+    def _tags(self):
         return (self._code_review() | self._verified() |
                 self._workflow() | self._backport_candidate())
 
-    @property
-    def last_update(self):
+    def _last_update(self):
         return datetime.datetime.strptime(
-            self.args['updated'][:19], "%Y-%m-%d %H:%M:%S")
+            self.updated[:19], "%Y-%m-%d %H:%M:%S")
+
+
+DETAILED_OPTIONS = '&o=DETAILED_LABELS&o=DETAILED_ACCOUNTS'
+
+
+def get_details(base_url, changes, workers=devboard.utils.DEFAULT_WORKERS,
+                **kwargs):
+    def detail(c):
+        updated = datetime.datetime.strptime(
+            c['updated'][:19], "%Y-%m-%d %H:%M:%S")
+
+        return devboard.utils.get(
+            '{}/changes/{}/detail'.format(base_url, c['_number']),
+            ttl=0,
+            not_before=updated,
+            **kwargs)
+
+    return devboard.utils.parallel_map(detail, changes, workers=workers)
 
 
 class GerritSource(Source):
     name = "gerrit"
 
+    # Events of stream-events that may change a card, change-merged and
+    # change-abandoned remove it from the query results
+    change_events = (
+        'patchset-created',
+        'comment-added',
+        'change-merged',
+        'change-abandoned',
+        'change-restored',
+        'change-deleted',
+        'topic-changed',
+        'wip-state-changed',
+        'private-state-changed',
+        'vote-deleted',
+        'reviewer-added',
+        'reviewer-deleted',
+    )
+    # Events that may add an unknown change to the query results
+    new_change_events = ('patchset-created', 'change-restored')
+
+    restart_delay = 5
+    max_restart_delay = 300
+
     def __init__(self, config):
         super(GerritSource, self).__init__(config)
 
@@ -63,24 +144,172 @@ class GerritSource(Source):
 
         self.verify = config.get('verify', True)
 
+        # Fetch labels and accounts in the list query instead of doing one
+        # /detail request per change, requires a server that supports these
+        # query options.
+        self.detailed_query = config.get('detailed_query', False)
+        self.workers = config.get('workers', devboard.utils.DEFAULT_WORKERS)
+        if 'concurrency' in config:
+            devboard.utils.set_host_concurrency(config['url'],
+                                                config['concurrency'])
+
+        # Push mode: the output of the events command (usually ssh <server>
+        # gerrit stream-events) is read while devboard runs, and only the
+        # changes named in the events are requested again. The full query is
+        # still done on the regular schedule of the source.
+        self.events_command = config.get('events', {}).get('command')
+        if isinstance(self.events_command, str):
+            self.events_command = shlex.split(self.events_command)
+        # The events received within delay seconds are handled by a single
+        # refresh
+        self.events_delay = config.get('events', {}).get('delay', 5)
+        self.event_filters = self._event_filters(
+            self.config['queries'][0]['filter'])
+
+        self.items = None
+        self.pending = set()
+        self.lock = threading.Lock()
+        # The full query runs at least every interval seconds, even while
+        # events are received
+        self.full_query_interval = config.get('interval')
+        self.last_full_query = None
+
+    def _query(self, query, ttl=30, cache=True):
+        url = '{}/changes/?q={}&n=50{}'.format(
+            self.config['url'], query,
+            DETAILED_OPTIONS if self.detailed_query else '')
+        changes = devboard.utils.iter_json(url, auth=self.auth,
+                                           verify=self.verify, ttl=ttl,
+                                           cache=cache)
+
+        if not self.detailed_query:
+            changes = get_details(self.config['url'], changes,
+                                  workers=self.workers,
+                                  auth=self.auth,
+                                  verify=self.verify)
+
+        return [GerritItem(self, **c) for c in changes]
+
     def get(self):
-        url = '{}/changes/?q={}&n=50'.format(
-            self.config['url'], '+'.join(self.config['queries'][0]['filter']))
-        changes = devboard.utils.get(url, auth=self.auth,
-                                     verify=self.verify, ttl=30)
+        filters = '+'.join(self.config['queries'][0]['filter'])
+
+        with self.lock:
+            pending, self.pending = self.pending, set()
 
+        now = time.monotonic()
+        try:
+            if (not pending or self.items is None or (
+                    self.full_query_interval and
+                    now - self.last_full_query >= self.full_query_interval)):
+                items = self._query(filters)
+                self.items = {i._number: i for i in items}
+                self.last_full_query = now
+                return items
+
+            # Only the changes named in events, those that don't match the
+            # query anymore are removed
+            query = '({})+{}'.format(
+                '+OR+'.join('change:{}'.format(n) for n in sorted(pending)),
+                filters)
+            changed = self._query(query, cache=False)
+        except Exception:
+            # Requested again on the next refresh
+            with self.lock:
+                self.pending |= pending
+            raise
+        items = dict(self.items)
+        for n in pending:
+            items.pop(n, None)
+        items.update((i._number, i) for i in changed)
+        self.items = items
+        return list(items.values())
+
+    @staticmethod
+    def _event_filters(filters):
+        # Returns the (field, value) of the project:, branch: and owner:
+        # terms of the query, which the changes of the events must match.
+        # Queries with alternatives are not filtered.
+        query = urllib.parse.unquote_plus('+'.join(filters))
+        if '(' in query or ' OR ' in query or '{' in query:
+            return []
         ret = []
-        for c in changes:
-            updated = datetime.datetime.strptime(
-                c['updated'][:19], "%Y-%m-%d %H:%M:%S")
-
-            detail = devboard.utils.get(
-                '{}/changes/{}/detail'.format(self.config['url'],
-                                              c['_number']),
-                auth=self.auth,
-                verify=self.verify,
-                ttl=0,
-                not_before=updated)
-
-            ret.append(GerritItem(self, **detail))
+        for term in query.split():
+            key, _, value = term.partition(':')
+            if key in ('project', 'branch', 'owner') and value:
+                ret.append((key, value.strip('"')))
         return ret
+
+    def _matches(self, change):
+        for key, value in self.event_filters:
+            if key == 'owner':
+                owner = change.get('owner', {})
+                if value != 'self' and value not in (
+                        owner.get('username'), owner.get('email'),
+                        owner.get('name')):
+                    return False
+            elif change.get(key) != value:
+                return False
+        return True
+
+    def _on_event(self, event):
+        change = event.get('change')
+        if event.get('type') not in self.change_events or not change:
+            return False
+        number = int(change['number'])
+        if self.items is not None and number not in self.items and (
+                event['type'] not in self.new_change_events or
+                not self._matches(change)):
+            return False
+        with self.lock:
+            self.pending.add(number)
+        return True
+
+    async def watch(self, notify):
+        if not self.events_command:
+            return
+
+        loop = asyncio.get_running_loop()
+        timer = None
+        delay = self.restart_delay
+        try:
+            while True:
+                LOG.info("Starting {}".format(' '.join(self.events_command)))
+                try:
+                    proc = await asyncio.create_subprocess_exec(
+                        *self.events_command,
+                        stdin=asyncio.subprocess.DEVNULL,
+                        stdout=asyncio.subprocess.PIPE)
+                except OSError as e:
+                    LOG.error("Cannot start the events command of {}: "
+                              "{}".format(self.unique_name, e))
+                else:
+                    try:
+                        while True:
+                            line = await proc.stdout.readline()
+                            if not line:
+                                break
+                            try:
+                                event = json.loads(line)
+                            except ValueError:
+                                LOG.warning("Invalid event from {}: "
+                                            "{!r:.100}".format(
+                                                self.unique_name, line))
+                                continue
+                            if not self._on_event(event):
+                                continue
+                            delay = self.restart_delay
+                            if timer is None or timer.when() <= loop.time():
+                                timer = loop.call_later(self.events_delay,
+                                                        notify)
+                    finally:
+                        if proc.returncode is None:
+                            proc.kill()
+                        await proc.wait()
+                    LOG.warning("Events command of {} exited with {}".format(
+                        self.unique_name, proc.returncode))
+
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_restart_delay)
+        finally:
+            if timer is not None:
+                timer.cancel()
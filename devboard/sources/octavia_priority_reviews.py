@@ -1,28 +1,31 @@
-import datetime
+import hashlib
 import re
 
 from devboard.source import Source
-from devboard.sources.gerrit import GerritItem
+from devboard.sources import gerrit
 import devboard.utils
 
 
-class GerritReviewItem(GerritItem):
+class GerritReviewItem(gerrit.GerritItem):
+    __slots__ = ('review_tag', 'review_url')
+    fields = gerrit.GerritItem.fields + __slots__
+
     def need_review(self):
-        if self.args['owner']['username'] == self.source.user:
+        if self.owner.get('username') == self.source.user:
             return False
-        for cr in self.args['labels'].get('Code-Review', {}).get('all', []):
-            if cr.get('username') == self.source.user and cr['value'] != 0:
+        for cr in self.labels.get('Code-Review', {}).get('all', []):
+            if (cr.get('username') == self.source.user and
+                    cr.get('value', 0) != 0):
                 return False
         return True
 
     def _is_backport(self):
-        branch = self.args.get('branch')
+        branch = getattr(self, 'branch', None)
         if branch and branch != 'master':
             return {'backport'}
         return set()
 
-    @property
-    def tags(self):
+    def _tags(self):
         return ({self.review_tag} | self._code_review() | self._verified() |
                 self._workflow() | self._backport_candidate() |
                 self._is_backport())
@@ -31,17 +34,28 @@ class GerritReviewItem(GerritItem):
 class OctaviaPriorityReviews(Source):
     name = "octavia-priority-reviews"
 
+    default_url = ("https://etherpad.openstack.org/p/octavia-priority-reviews/"
+                   "export/txt")
+
     def __init__(self, config):
         super(OctaviaPriorityReviews, self).__init__(config)
 
         self.user = config.get('username')
+        self.url = config.get('url', self.default_url)
 
-    def get(self):
-        url = ("https://etherpad.openstack.org/p/octavia-priority-reviews/"
-               "export/txt")
+        # Changes are requested by chunks of chunk_size ids, to keep the
+        # URLs short, and by pages of page_size results. Labels and accounts
+        # are included in the list query unless detailed_query is false.
+        self.detailed_query = config.get('detailed_query', True)
+        self.workers = config.get('workers', devboard.utils.DEFAULT_WORKERS)
+        self.chunk_size = config.get('chunk_size', 50)
+        self.page_size = config.get('page_size', 100)
 
-        content = devboard.utils.get(url)
+        self.pad_digest = None
+        self.review_urls = {}
+        self.id_tags = {}
 
+    def _parse(self, content):
         current_tag = None
 
         review_urls = {}
@@ -72,27 +86,51 @@ class OctaviaPriorityReviews(Source):
             review_urls[d['base']].append(d['id'])
             id_tags[int(d['id'])] = current_tag
 
-        ret = []
+        return review_urls, id_tags
+
+    def _query(self, base_url, ids):
+        # Pages through the results, the last change of a page has
+        # _more_changes set when there are more results
+        offset = 0
+        while True:
+            url = '{}/changes/?q={}&n={}&S={}{}'.format(
+                base_url, '+OR+'.join(ids), self.page_size, offset,
+                gerrit.DETAILED_OPTIONS if self.detailed_query else '')
+            c = None
+            count = 0
+            for c in devboard.utils.iter_json(url, ttl=30):
+                count += 1
+                yield c
+
+            if not c or not c.get('_more_changes'):
+                break
+            offset += count
 
-        for base_url, ids in review_urls.items():
+    def get(self):
+        # The pad is only parsed again when its content changes
+        content = devboard.utils.get(self.url)
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        if digest != self.pad_digest:
+            self.review_urls, self.id_tags = self._parse(content)
+            self.pad_digest = digest
 
-            url = '{}/changes/?q={}&n=100'.format(
-                base_url, '+OR+'.join(ids))
-            changes = devboard.utils.get(url, ttl=30)
+        ret = []
 
-            for c in changes:
-                updated = datetime.datetime.strptime(
-                    c['updated'][:19], "%Y-%m-%d %H:%M:%S")
+        for base_url, ids in self.review_urls.items():
+            chunks = [ids[i:i + self.chunk_size]
+                      for i in range(0, len(ids), self.chunk_size)]
+            changes = devboard.utils.parallel_chain(
+                [self._query(base_url, chunk) for chunk in chunks],
+                workers=self.workers)
 
-                detail = devboard.utils.get(
-                    '{}/changes/{}/detail'.format(base_url,
-                                                  c['_number']),
-                    ttl=0,
-                    not_before=updated)
+            if not self.detailed_query:
+                changes = gerrit.get_details(base_url, changes,
+                                             workers=self.workers)
 
+            for c in changes:
                 orig_url = "{}/#/c/{}".format(base_url, c['_number'])
-                tag = id_tags.get(c['_number'])
-                item = GerritReviewItem(self, **detail, review_tag=tag,
+                tag = self.id_tags.get(c['_number'])
+                item = GerritReviewItem(self, **c, review_tag=tag,
                                         review_url=orig_url)
                 if item.need_review():
                     ret.append(item)
@@ -0,0 +1,248 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import devboard.metrics as metrics
+import devboard.reconcile as reconcile
+
+
+LOG = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS boards (
+    board_id TEXT PRIMARY KEY,
+    reconciled REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lists (
+    board_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    list_id TEXT NOT NULL,
+    PRIMARY KEY (board_id, name)
+);
+CREATE TABLE IF NOT EXISTS labels (
+    board_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    label_id TEXT NOT NULL,
+    color TEXT,
+    PRIMARY KEY (board_id, name)
+);
+CREATE TABLE IF NOT EXISTS cards (
+    board_id TEXT NOT NULL,
+    unique_id TEXT NOT NULL,
+    card_id TEXT NOT NULL,
+    list_id TEXT NOT NULL,
+    pos REAL NOT NULL,
+    label_ids TEXT NOT NULL,
+    state TEXT NOT NULL,
+    fingerprint TEXT,
+    PRIMARY KEY (board_id, unique_id)
+);
+"""
+
+
+class StateStore(object):
+    # Maps the unique_id of the items written to Trello to their card, list
+    # and labels, the hash of the content of the card (see
+    # reconcile.card_state()) and the fingerprint of the item last written,
+    # so boards are not downloaded and their cards scanned for their
+    # devboardId attachment on each refresh. Rows are written in a
+    # transaction after each successful write to Trello.
+    # The store is checked against Trello every reconcile_interval seconds:
+    # the board is downloaded and replaces the rows of the board, the
+    # fingerprints are kept for the cards that have not been modified since
+    # they were written. A board is also reconciled after a failed write.
+    default_settings = {
+        'path': '~/.cache/devboard/state.sqlite',
+        'reconcile_interval': 3600,
+    }
+
+    def __init__(self):
+        self.settings = dict(self.default_settings)
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def configure(self, **settings):
+        with self.lock:
+            if settings.get('path', self.settings['path']) != \
+                    self.settings['path'] and self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            self.settings.update(settings)
+
+    def _connect(self):
+        if self.conn is None:
+            path = os.path.expanduser(self.settings['path'])
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Outputs are updated from several threads, the connection is
+            # serialized by the lock
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.executescript(SCHEMA)
+        return self.conn
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def load(self, board_id):
+        # Returns the board in the format of a Trello board snapshot, and
+        # the (fingerprint, card state) of the items written to it, or None
+        # when the board has to be reconciled
+        with self.lock:
+            conn = self._connect()
+            row = conn.execute("SELECT reconciled FROM boards "
+                               "WHERE board_id = ?", (board_id,)).fetchone()
+            if (row is None or time.time() - row[0] >=
+                    self.settings['reconcile_interval']):
+                return None
+
+            lists = [{'id': list_id, 'name': name}
+                     for name, list_id in conn.execute(
+                         "SELECT name, list_id FROM lists "
+                         "WHERE board_id = ?", (board_id,))]
+            labels = [{'id': label_id, 'name': name, 'color': color}
+                      for name, label_id, color in conn.execute(
+                          "SELECT name, label_id, color FROM labels "
+                          "WHERE board_id = ?", (board_id,))]
+            rows = conn.execute(
+                "SELECT unique_id, card_id, list_id, pos, label_ids, state, "
+                "fingerprint FROM cards WHERE board_id = ?",
+                (board_id,)).fetchall()
+
+        labels_by_id = {label['id']: label for label in labels}
+        cards = []
+        pushed = {}
+        for (unique_id, card_id, list_id, pos, label_ids, state,
+             fingerprint) in rows:
+            label_ids = [i for i in label_ids.split(',') if i]
+            # Cards from the store have no name nor description, only the
+            # hash of their content
+            cards.append({
+                'id': card_id,
+                'unique_id': unique_id,
+                'idList': list_id,
+                'pos': pos,
+                'idLabels': label_ids,
+                'labels': [labels_by_id[i] for i in label_ids
+                           if i in labels_by_id],
+                'state': state,
+            })
+            if fingerprint is not None:
+                pushed[unique_id] = (fingerprint, state)
+
+        metrics.inc('devboard_state_loads_total')
+        return {'lists': lists, 'labels': labels, 'cards': cards}, pushed
+
+    def reconcile(self, board_id, snapshot, pushed):
+        # Replaces the rows of the board with the snapshot downloaded from
+        # Trello. Fingerprints are kept, and added to pushed, for the cards
+        # whose content is the one devboard last wrote.
+        cards = []
+        for c in snapshot.cards_by_unique_id.values():
+            cards.append((c, reconcile.card_state(c),
+                          ','.join(sorted(label['id'] for label in c.labels))))
+
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                old = {r[0]: r[1:] for r in conn.execute(
+                    "SELECT unique_id, card_id, list_id, label_ids, state, "
+                    "fingerprint FROM cards WHERE board_id = ?",
+                    (board_id,))}
+                for table in ('lists', 'labels', 'cards'):
+                    conn.execute("DELETE FROM {} WHERE board_id = ?".format(
+                        table), (board_id,))
+
+                conn.executemany(
+                    "INSERT INTO lists VALUES (?, ?, ?)",
+                    [(board_id, li.name, li.id)
+                     for li in snapshot.lists.values()])
+                conn.executemany(
+                    "INSERT INTO labels VALUES (?, ?, ?, ?)",
+                    [(board_id, label.name, label.id,
+                      label.args.get('color'))
+                     for label in snapshot.labels.values()])
+
+                mismatches = 0
+                rows = []
+                for c, state, label_ids in cards:
+                    row = old.pop(c.unique_id, None)
+                    fingerprint = None
+                    if pushed.get(c.unique_id, (None, None))[1] == state:
+                        fingerprint = pushed[c.unique_id][0]
+                    elif row is not None and row[3] == state and row[4]:
+                        fingerprint = row[4]
+                        pushed[c.unique_id] = (fingerprint, state)
+                    if row is None or row[:4] != (c.id, c.idList, label_ids,
+                                                  state):
+                        mismatches += 1
+                    rows.append((board_id, c.unique_id, c.id, c.idList,
+                                 c.pos, label_ids, state, fingerprint))
+                # Cards archived or deleted on Trello
+                mismatches += len(old)
+                conn.executemany(
+                    "INSERT INTO cards VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows)
+
+                conn.execute("INSERT OR REPLACE INTO boards VALUES (?, ?)",
+                             (board_id, time.time()))
+
+        LOG.info("Reconciled board {}: {} cards, {} differed from the state "
+                 "store".format(board_id, len(cards), mismatches))
+        metrics.inc('devboard_state_reconciliations_total')
+        metrics.inc('devboard_state_mismatches_total', mismatches)
+
+    def set_list(self, board_id, li):
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO lists VALUES (?, ?, ?)",
+                             (board_id, li.name, li.id))
+
+    def set_label(self, board_id, label):
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?)",
+                    (board_id, label.name, label.id, label.args.get('color')))
+
+    def set_card(self, board_id, c, fingerprint=None):
+        # The fingerprint is kept when the card is written without an item
+        # (new position, moved to Done)
+        label_ids = ','.join(sorted(label['id'] for label in c.labels))
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT INTO cards VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (board_id, unique_id) DO UPDATE SET "
+                    "card_id = excluded.card_id, list_id = excluded.list_id, "
+                    "pos = excluded.pos, label_ids = excluded.label_ids, "
+                    "state = excluded.state, fingerprint = "
+                    "coalesce(excluded.fingerprint, fingerprint)",
+                    (board_id, c.unique_id, c.id, c.idList, c.pos, label_ids,
+                     reconcile.card_state(c), fingerprint))
+
+    def invalidate(self, board_id):
+        # The board is reconciled on its next load
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM boards WHERE board_id = ?",
+                             (board_id,))
+
+    def clear(self):
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                for table in ('boards', 'lists', 'labels', 'cards'):
+                    conn.execute("DELETE FROM {}".format(table))
+
+
+store = StateStore()
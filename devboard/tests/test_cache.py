@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import devboard.cache as cache
+
+
+class TestAPICache(unittest.TestCase):
+    data = {'bugs': [{'id': i, 'summary': 'Bug {}'.format(i)}
+                     for i in range(100)]}
+
+    def setUp(self):
+        home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home)
+        with mock.patch.dict(os.environ, {'HOME': home}):
+            self.cache = cache.APICache('devboard-test')
+
+    def write(self, h, content):
+        with open(self.cache._path(h), 'wb') as fp:
+            fp.write(content)
+
+    def test_legacy_entry(self):
+        # No header, written before the validators were stored
+        self.write('h', json.dumps(self.data).encode('utf-8'))
+        self.assertEqual(self.cache.get('h', 0, None), self.data)
+        self.assertEqual(self.cache.validators('h'), {})
+
+    def test_v1_entry(self):
+        # Header with the validators only
+        self.write('h', json.dumps({'ETag': '"abc"'}).encode('utf-8') +
+                   b'\n' + json.dumps(self.data).encode('utf-8'))
+        self.assertEqual(self.cache.validators('h'), {'ETag': '"abc"'})
+        self.assertEqual(self.cache.get('h', 0, None), self.data)
+
+    def test_v1_entry_open(self):
+        self.write('h', b'{}\n' + json.dumps(self.data).encode('utf-8'))
+        data, fp = self.cache.open('h', 0, None)
+        self.assertIsNone(fp)
+        self.assertEqual(data, self.data)
+
+    def test_validators_header_only(self):
+        # The body is not decoded, it is not even valid here
+        self.write('h', cache._header({'ETag': '"1"'}, 'json', 'zlib') +
+                   b'not zlib')
+        self.write('legacy', json.dumps(self.data).encode('utf-8'))
+        with mock.patch.object(cache, '_loads') as loads:
+            self.assertEqual(self.cache.validators('h'), {'ETag': '"1"'})
+            self.assertEqual(self.cache.validators('legacy'), {})
+        loads.assert_not_called()
+
+    def test_newer_version(self):
+        self.write('h', json.dumps({
+            'version': cache.FORMAT_VERSION + 1, 'format': 'json',
+            'compression': None, 'validators': {}}).encode('utf-8') +
+            b'\n' + json.dumps(self.data).encode('utf-8'))
+        self.assertIsNone(self.cache.get('h', 0, None))
+        self.assertEqual(self.cache.open('h', 0, None), (None, None))
+
+    def test_formats(self):
+        for serializer in cache.SERIALIZERS:
+            for compression in (None,) + tuple(cache.COMPRESSORS):
+                self.cache.configure(serializer=serializer,
+                                     compression=compression)
+                self.cache.set('h', self.data, {'ETag': '"1"'})
+                # Read from the file
+                self.cache.configure(memory_entries=0)
+                self.cache.configure(memory_entries=1024)
+                self.assertEqual(self.cache.get('h', 0, None), self.data,
+                                 (serializer, compression))
+                self.assertEqual(self.cache.validators('h'),
+                                 {'ETag': '"1"'})
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self.cache.configure(serializer='unknown')
+        with self.assertRaises(ValueError):
+            self.cache.configure(compression='unknown')
+
+    def test_memory_size(self):
+        # Entries are counted with their uncompressed size
+        self.cache.configure(compression='zlib')
+        self.cache.set('h', self.data)
+        size = len(json.dumps(self.data).encode('utf-8'))
+        self.assertEqual(self.cache.memory_bytes, size)
+        self.assertLess(self.cache.index['h'].size, size)
+
+    def test_open_large_entry(self):
+        self.cache.configure(stream_bytes=100)
+        self.cache.set('h', self.data)
+        self.cache.configure(memory_entries=0)
+        self.cache.configure(memory_entries=1024)
+        data, fp = self.cache.open('h', 0, None)
+        self.assertIsNone(data)
+        with fp:
+            self.assertEqual(json.loads(fp.read()), self.data)
@@ -0,0 +1,34 @@
+import unittest
+
+import devboard.engine as engine
+
+
+class TestSchedule(unittest.TestCase):
+    def test_backoff(self):
+        s = engine.Schedule(100, max_interval=300, jitter=0)
+        for now, next_run in ((0, 100), (100, 300), (300, 600), (600, 900)):
+            s.start(now)
+            s.update([], now)
+            self.assertEqual(s.next_run, next_run)
+
+    def test_wake_keeps_schedule(self):
+        # Refreshes requested by wake() don't move the next scheduled one
+        s = engine.Schedule(100, jitter=0)
+        s.start(0)
+        s.update([], 0)
+        for now in (30, 60, 90):
+            s.wake()
+            self.assertEqual(s.next_run, 0)
+            s.start(now)
+            s.update([], now)
+            self.assertEqual(s.next_run, 100)
+
+    def test_wake_during_refresh(self):
+        s = engine.Schedule(100, jitter=0)
+        s.start(0)
+        s.wake()
+        s.update([], 0)
+        self.assertEqual(s.next_run, 0)
+        s.start(0)
+        s.failed(0)
+        self.assertEqual(s.next_run, 100)
@@ -0,0 +1,68 @@
+import unittest
+from unittest import mock
+
+from devboard.sources import gerrit
+
+
+class Change(object):
+    def __init__(self, number):
+        self._number = number
+
+
+class TestGerritSource(unittest.TestCase):
+    def setUp(self):
+        self.source = gerrit.GerritSource({
+            'name': 'gerrit', 'type': 'gerrit',
+            'url': 'https://review.example.com',
+            'interval': 3600,
+            'queries': [{'filter': ['status:open', 'project:octavia']}],
+        })
+        self.queries = []
+        self.results = [Change(1), Change(2)]
+
+        def query(q, **kwargs):
+            self.queries.append(q)
+            return self.results
+        patcher = mock.patch.object(self.source, '_query', query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def event(self, number, event_type='comment-added'):
+        return self.source._on_event({
+            'type': event_type,
+            'change': {'number': number, 'project': 'octavia',
+                       'branch': 'master', 'owner': {}}})
+
+    def test_partial_query(self):
+        self.source.get()
+        self.assertTrue(self.event(2))
+        self.results = [Change(2)]
+        self.assertEqual(len(self.source.get()), 2)
+        self.assertEqual(self.queries, ['status:open+project:octavia',
+                                        '(change:2)+status:open+'
+                                        'project:octavia'])
+
+    def test_event_filter(self):
+        self.source.get()
+        self.assertFalse(self.event(3))
+        self.assertTrue(self.event(3, 'patchset-created'))
+        self.assertFalse(self.source._on_event({
+            'type': 'patchset-created',
+            'change': {'number': 4, 'project': 'other'}}))
+
+    def test_full_query_interval(self):
+        with mock.patch('time.monotonic', return_value=0):
+            self.source.get()
+        self.event(2)
+        with mock.patch('time.monotonic', return_value=3600):
+            self.source.get()
+        self.assertEqual(self.queries, ['status:open+project:octavia'] * 2)
+
+    def test_failed_partial_query(self):
+        self.source.get()
+        self.event(2)
+        with mock.patch.object(self.source, '_query',
+                               side_effect=gerrit.devboard.utils
+                               .NetworkException('error')):
+            self.assertRaises(Exception, self.source.get)
+        self.assertEqual(self.source.pending, {2})
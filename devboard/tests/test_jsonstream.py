@@ -0,0 +1,60 @@
+import json
+import unittest
+
+import devboard.jsonstream as jsonstream
+
+
+def split(content, size):
+    return [content[i:i + size] for i in range(0, len(content), size)]
+
+
+class TestIterArray(unittest.TestCase):
+    doc = {
+        'faults': [],
+        'total': 3,
+        'bugs': [
+            {'id': 1234567, 'summary': 'A "quoted" \\ summary',
+             'score': -12.5e3},
+            {'id': 89, 'summary': 'Café ☃', 'flags': [True, None]},
+            {'id': 1000000000000, 'summary': ''},
+        ],
+    }
+
+    def test_chunk_sizes(self):
+        # Numbers, strings, escapes and multi-byte characters are split
+        # across chunks of every size
+        content = json.dumps(self.doc, ensure_ascii=False).encode('utf-8')
+        for size in range(1, len(content) + 1):
+            self.assertEqual(
+                list(jsonstream.iter_array(split(content, size),
+                                           ('bugs',))),
+                self.doc['bugs'], size)
+
+    def test_number_at_chunk_end(self):
+        self.assertEqual(list(jsonstream.iter_array([b'[12', b'34, 5',
+                                                     b'6]'])),
+                         [1234, 56])
+
+    def test_top_level_array(self):
+        self.assertEqual(list(jsonstream.iter_array([b' [1, "a", {}] '])),
+                         [1, 'a', {}])
+
+    def test_empty_and_null(self):
+        self.assertEqual(list(jsonstream.iter_array([b'[]'])), [])
+        self.assertEqual(list(jsonstream.iter_array([b'{"bugs": null}'],
+                                                    ('bugs',))), [])
+
+    def test_xssi_prefix(self):
+        content = b")]}'\n" + json.dumps([{'_number': 1}]).encode('utf-8')
+        for size in range(1, len(content) + 1):
+            self.assertEqual(list(jsonstream.iter_array(split(content,
+                                                              size))),
+                             [{'_number': 1}], size)
+
+    def test_missing_key(self):
+        with self.assertRaises(jsonstream.JSONStreamError):
+            list(jsonstream.iter_array([b'{"faults": []}'], ('bugs',)))
+
+    def test_truncated(self):
+        with self.assertRaises(jsonstream.JSONStreamError):
+            list(jsonstream.iter_array([b'[{"id": 1}, {"id"']))
@@ -0,0 +1,167 @@
+import unittest
+
+import devboard.reconcile as reconcile
+import devboard.trello as trello
+
+
+class FakeItem(object):
+    def __init__(self, unique_id, last_update, summary=None, content=None,
+                 tags=(), fingerprint=None):
+        self.unique_id = unique_id
+        self.last_update = last_update
+        self.summary = summary or 'Item {}'.format(unique_id)
+        self.content = content or 'Content of {}'.format(unique_id)
+        self.tags = list(tags)
+        self.fingerprint = fingerprint or 'fp-{}'.format(unique_id)
+
+    def label_color(self, tag):
+        return 'blue'
+
+
+def card(item, pos, list_id='list1', labels=()):
+    return {
+        'id': 'card-{}'.format(item.unique_id),
+        'idList': list_id,
+        'name': item.summary,
+        'desc': item.content,
+        'pos': pos,
+        'labels': [{'id': 'label-{}'.format(name), 'name': name}
+                   for name in labels],
+        'attachments': [{'name': 'devboardId',
+                         'url': 'http://devboard/{}'.format(item.unique_id)}],
+    }
+
+
+def snapshot(cards, labels=(), lists=('Todo',)):
+    return trello.TrelloSnapshot(None, 'board1', {
+        'lists': [{'id': 'list{}'.format(i), 'name': name}
+                  for i, name in enumerate(lists, 1)],
+        'labels': [{'id': 'label-{}'.format(name), 'name': name}
+                   for name in labels],
+        'cards': cards,
+    })
+
+
+class TestPositions(unittest.TestCase):
+    def test_in_order(self):
+        self.assertEqual(reconcile.positions(
+            ['a', 'b', 'c'], {'a': 1.0, 'b': 2.0, 'c': 3.0}), {})
+
+    def test_new_cards_at_the_bottom(self):
+        self.assertEqual(reconcile.positions(
+            ['a', 'b', 'c'], {'a': 1.0}),
+            {'b': 1.0 + reconcile.POS_STEP,
+             'c': 1.0 + 2 * reconcile.POS_STEP})
+
+    def test_new_card_between(self):
+        self.assertEqual(reconcile.positions(
+            ['a', 'b', 'c'], {'a': 1.0, 'c': 4.0}), {'b': 2.5})
+
+    def test_move_one_card(self):
+        # Only the card out of order gets a new position
+        ret = reconcile.positions(
+            ['b', 'c', 'd', 'a'], {'a': 1.0, 'b': 2.0, 'c': 3.0, 'd': 4.0})
+        self.assertEqual(list(ret), ['a'])
+        self.assertGreater(ret['a'], 4.0)
+
+    def test_reversed(self):
+        current = {'a': 1.0, 'b': 2.0, 'c': 3.0}
+        ret = reconcile.positions(['c', 'b', 'a'], current)
+        self.assertEqual(len(ret), 2)
+        pos = dict(current, **ret)
+        self.assertLess(pos['c'], pos['b'])
+        self.assertLess(pos['b'], pos['a'])
+
+
+class TestPlanList(unittest.TestCase):
+    def setUp(self):
+        self.items = [FakeItem('a', 3, tags=['x']), FakeItem('b', 2),
+                      FakeItem('c', 1)]
+
+    def test_new_list(self):
+        ops = reconcile.plan_list(snapshot([], lists=()), 'Todo', self.items)
+        self.assertEqual(
+            [(op.action, op.params.get('name')) for op in ops],
+            [('list_create', 'Todo'),
+             ('label_create', 'x'),
+             ('card_create', 'Item a'),
+             ('card_create', 'Item b'),
+             ('card_create', 'Item c')])
+
+    def test_steady_state(self):
+        s = snapshot([card(self.items[0], 1.0, labels=['x']),
+                      card(self.items[1], 2.0),
+                      card(self.items[2], 3.0)], labels=['x'])
+        pushed = {}
+        self.assertEqual(reconcile.plan_list(s, 'Todo', self.items,
+                                             pushed=pushed), [])
+        # Unchanged cards are recorded, and not compared again
+        self.assertEqual(set(pushed), {'a', 'b', 'c'})
+        self.assertEqual(reconcile.plan_list(s, 'Todo', self.items,
+                                             pushed=pushed), [])
+
+    def test_reorder(self):
+        s = snapshot([card(self.items[0], 2.0, labels=['x']),
+                      card(self.items[1], 1.0),
+                      card(self.items[2], 3.0)], labels=['x'])
+        ops = reconcile.plan_list(s, 'Todo', self.items)
+        self.assertEqual(len(ops), 1)
+        self.assertEqual(ops[0].action, 'card_update')
+        self.assertEqual(list(ops[0].params), ['pos'])
+
+    def test_same_last_update(self):
+        a, b = FakeItem('a', 1), FakeItem('b', 1)
+        s = snapshot([card(b, 1.0), card(a, 2.0)])
+        self.assertEqual(reconcile.plan_list(s, 'Todo', [a, b]), [])
+        self.assertEqual(reconcile.plan_list(s, 'Todo', [b, a]), [])
+
+    def test_update(self):
+        s = snapshot([card(self.items[0], 1.0),
+                      card(self.items[1], 2.0),
+                      card(self.items[2], 3.0)], labels=['x'])
+        self.items[1].summary = 'New summary'
+        ops = reconcile.plan_list(s, 'Todo', self.items)
+        self.assertEqual([(op.card.unique_id, sorted(op.params))
+                          for op in ops],
+                         [('a', ['labels']), ('b', ['name'])])
+
+    def test_archived(self):
+        old = FakeItem('old', 0)
+        s = snapshot([card(self.items[0], 1.0, labels=['x']),
+                      card(self.items[1], 2.0),
+                      card(self.items[2], 3.0),
+                      card(old, 4.0)], labels=['x'])
+        ops = reconcile.plan_list(s, 'Todo', self.items)
+        self.assertEqual([(op.action, op.params) for op in ops],
+                         [('list_create', {'name': 'Done'}),
+                          ('card_update', {'list': 'Done', 'pos': 'top'})])
+        self.assertEqual(ops[1].card.unique_id, 'old')
+
+    def test_stored_card(self):
+        # Cards of the state store only have the hash of their content
+        item = self.items[1]
+        s = snapshot([{'id': 'card-b', 'unique_id': 'b', 'idList': 'list1',
+                       'pos': 1.0, 'labels': [],
+                       'state': reconcile.content_state(
+                           item.summary, item.content, [])}])
+        self.assertEqual(reconcile.plan_list(s, 'Todo', [item]), [])
+
+        item.content = 'New content'
+        ops = reconcile.plan_list(s, 'Todo', [item])
+        self.assertEqual(sorted(ops[0].params), ['desc', 'name'])
+
+
+class TestCoalesce(unittest.TestCase):
+    def test_coalesce(self):
+        s = snapshot([card(FakeItem('a', 1), 1.0)])
+        c = s.cards_by_unique_id['a']
+        ops = reconcile.coalesce([
+            reconcile.Operation('list_create', name='Done'),
+            reconcile.Operation('card_update', card=c, name='New'),
+            reconcile.Operation('card_update', card=c, list='Done',
+                                pos='top'),
+        ])
+        self.assertEqual([(op.action, op.params) for op in ops],
+                         [('list_create', {'name': 'Done'}),
+                          ('card_update', {'name': 'New', 'list': 'Done',
+                                           'pos': 'top'})])
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import devboard.reconcile as reconcile
+import devboard.state as state
+
+from devboard.tests.test_reconcile import FakeItem, card, snapshot
+
+
+class TestStateStore(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.store = state.StateStore()
+        self.store.configure(path=os.path.join(tmp, 'state.sqlite'))
+        self.addCleanup(self.store.close)
+
+        self.items = [FakeItem('a', 1), FakeItem('b', 2)]
+
+    def snapshot(self, **descs):
+        cards = [card(item, i) for i, item in enumerate(self.items, 1)]
+        for c in cards:
+            unique_id = c['attachments'][0]['url'].split('/')[-1]
+            c['desc'] = descs.get(unique_id, c['desc'])
+        return snapshot(cards, labels=('bug',))
+
+    def write_all(self, s):
+        # Cards written by devboard with the fingerprint of their item
+        for item in self.items:
+            self.store.set_card('board1', s.cards_by_unique_id[item.unique_id],
+                                item.fingerprint)
+
+    def test_load(self):
+        self.assertIsNone(self.store.load('board1'))
+
+        s = self.snapshot()
+        self.store.reconcile('board1', s, {})
+        data, pushed = self.store.load('board1')
+        self.assertEqual(pushed, {})
+        self.assertEqual(data['lists'], [{'id': 'list1', 'name': 'Todo'}])
+        self.assertEqual([label['name'] for label in data['labels']],
+                         ['bug'])
+        self.assertEqual(
+            {c['unique_id']: (c['id'], c['idList'], c['pos'], c['state'])
+             for c in data['cards']},
+            {c.unique_id: (c.id, c.idList, c.pos, reconcile.card_state(c))
+             for c in s.cards_by_unique_id.values()})
+
+    def test_reconcile_interval(self):
+        self.store.configure(reconcile_interval=60)
+        self.store.reconcile('board1', self.snapshot(), {})
+        now = time.time()
+        with mock.patch.object(state.time, 'time', return_value=now + 59):
+            self.assertIsNotNone(self.store.load('board1'))
+        with mock.patch.object(state.time, 'time', return_value=now + 61):
+            self.assertIsNone(self.store.load('board1'))
+
+    def test_reconcile_fingerprints(self):
+        s = self.snapshot()
+        self.store.reconcile('board1', s, {})
+        self.write_all(s)
+
+        # Card b is edited on Trello, only the fingerprint of a is kept
+        pushed = {}
+        self.store.reconcile('board1', self.snapshot(b='Edited'), pushed)
+        state_a = reconcile.card_state(s.cards_by_unique_id['a'])
+        self.assertEqual(pushed, {'a': ('fp-a', state_a)})
+        self.assertEqual(self.store.load('board1')[1],
+                         {'a': ('fp-a', state_a)})
+
+    def test_reconcile_pushed(self):
+        # Fingerprints of cards written since the last load are taken from
+        # pushed when the card still matches
+        s = self.snapshot()
+        pushed = {
+            'a': ('fp-a', reconcile.card_state(s.cards_by_unique_id['a'])),
+            'b': ('fp-b', 'other state'),
+        }
+        self.store.reconcile('board1', s, pushed)
+        self.assertEqual(self.store.load('board1')[1], {'a': pushed['a']})
+
+    def test_set_card_keeps_fingerprint(self):
+        s = self.snapshot()
+        self.store.reconcile('board1', s, {})
+        self.write_all(s)
+
+        # Moved without an item, the fingerprint is kept
+        data, _ = self.store.load('board1')
+        loaded = snapshot(data['cards'], labels=('bug',))
+        c = loaded.cards_by_unique_id['a']
+        c.args['pos'] = 10.0
+        c.args['idList'] = 'list2'
+        self.store.set_card('board1', c)
+
+        data, pushed = self.store.load('board1')
+        self.assertEqual(pushed['a'][0], 'fp-a')
+        self.assertEqual(
+            [(c['idList'], c['pos']) for c in data['cards']
+             if c['unique_id'] == 'a'],
+            [('list2', 10.0)])
+
+    def test_invalidate(self):
+        self.store.reconcile('board1', self.snapshot(), {})
+        self.store.reconcile('board2', self.snapshot(), {})
+        self.store.invalidate('board1')
+        self.assertIsNone(self.store.load('board1'))
+        self.assertIsNotNone(self.store.load('board2'))
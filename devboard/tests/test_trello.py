@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+
+import devboard.reconcile as reconcile
+import devboard.trello as trello
+import devboard.utils as utils
+
+from devboard.tests.test_reconcile import FakeItem, card, snapshot
+
+
+class TestApply(unittest.TestCase):
+    def setUp(self):
+        self.trello = trello.Trello({'auth': {'key': 'k', 'token': 't'}})
+        self.board = trello.TrelloBoard(self.trello, id='board1')
+        self.store = mock.patch.object(trello.state, 'store').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_network_error(self):
+        items = [FakeItem('a', 1), FakeItem('b', 2)]
+        s = snapshot([card(item, i) for i, item in enumerate(items)])
+        ops = [reconcile.Operation(reconcile.Operation.CARD_UPDATE,
+                                   card=s.cards_by_unique_id[item.unique_id],
+                                   item=item, pos=10)
+               for item in items]
+
+        def card_update(c, **params):
+            if c.unique_id == 'a':
+                raise utils.NetworkException("Connection reset")
+            return c
+
+        with mock.patch.object(self.trello, 'card_update',
+                               side_effect=card_update):
+            self.trello.apply(self.board, ops)
+
+        # The failed write is skipped, the next one is still applied
+        self.store.invalidate.assert_called_once_with('board1')
+        self.store.set_card.assert_called_once_with(
+            'board1', s.cards_by_unique_id['b'], 'fp-b')
+        self.assertNotIn('a', self.trello.pushed)
+
+    def test_snapshot_not_cached(self):
+        self.store.load.return_value = None
+        data = {'lists': [], 'labels': [], 'cards': []}
+        with mock.patch.object(utils, 'get', return_value=data) as get:
+            self.trello.snapshot('board1')
+            self.trello.snapshot('board1')
+
+        get.assert_called_once()
+        self.assertIs(get.call_args[1]['cache'], False)
+        self.store.reconcile.assert_called_once()
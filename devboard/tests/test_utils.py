@@ -0,0 +1,135 @@
+import asyncio
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import devboard.cache as cache
+import devboard.utils as utils
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Serves the same JSON document with an ETag, and 304 to the requests
+    # with this ETag. The first server.failures requests get 503.
+    etag = '"1"'
+    body = json.dumps({'bugs': [{'id': 1}, {'id': 2}]}).encode('utf-8')
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('If-None-Match'))
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home)
+        with mock.patch.dict(os.environ, {'HOME': home}):
+            self.cache = cache.APICache('devboard-test')
+        patcher = mock.patch.object(utils.get, 'cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.failures = 0
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/rest/bug'.format(
+            self.server.server_port)
+
+
+class TestIterJSON(ServerTestCase):
+    def iter_json(self, **kwargs):
+        return list(utils.iter_json(self.url, ('bugs',), **kwargs))
+
+    def test_cached(self):
+        self.assertEqual(self.iter_json(), [{'id': 1}, {'id': 2}])
+        self.assertEqual(self.iter_json(), [{'id': 1}, {'id': 2}])
+        self.assertEqual(self.server.requests, [None])
+
+    def test_not_modified(self):
+        self.iter_json()
+        self.assertEqual(self.iter_json(ttl=-1), [{'id': 1}, {'id': 2}])
+        self.assertEqual(self.server.requests, [None, '"1"'])
+
+    def test_not_modified_entry_removed(self):
+        # The file of the entry is removed (devboard cache prune) while its
+        # validators are still in memory
+        self.iter_json()
+        h = self.cache.key(self.url)
+        os.unlink(self.cache._path(h))
+        self.assertEqual(self.iter_json(ttl=-1), [{'id': 1}, {'id': 2}])
+        self.assertEqual(self.server.requests, [None, '"1"', None])
+
+
+class TestRetries(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(utils.http_settings, retries=2, backoff=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_send(self):
+        self.server.failures = 2
+        self.assertEqual(utils.get(self.url, cache=False),
+                         json.loads(Handler.body))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_send_retries_exhausted(self):
+        self.server.failures = 3
+        with self.assertRaises(utils.HttpException):
+            utils.get(self.url, cache=False)
+        self.assertEqual(len(self.server.requests), 3)
+
+    @unittest.skipIf(utils.aiohttp is None, "aiohttp is not installed")
+    def test_async_send(self):
+        async def get():
+            try:
+                return await utils.async_get(self.url, cache=False)
+            finally:
+                await utils.async_close()
+
+        self.server.failures = 2
+        self.assertEqual(asyncio.run(get()), json.loads(Handler.body))
+        self.assertEqual(len(self.server.requests), 3)
+
+        self.server.failures = 3
+        with self.assertRaises(utils.HttpException):
+            asyncio.run(get())
+
+    @unittest.skipIf(utils.aiohttp is None, "aiohttp is not installed")
+    def test_async_get_not_modified(self):
+        async def get():
+            try:
+                return await utils.async_get(self.url, ttl=-1)
+            finally:
+                await utils.async_close()
+
+        self.assertEqual(asyncio.run(get()), json.loads(Handler.body))
+        self.assertEqual(asyncio.run(get()), json.loads(Handler.body))
+        self.assertEqual(self.server.requests, [None, '"1"'])
@@ -1,35 +1,134 @@
+import json
+import logging
+import sys
+import threading
+
+import devboard.metrics as metrics
 import devboard.utils as utils
-import devboard.item as item
+import devboard.reconcile as reconcile
+import devboard.state as state
+
+
+LOG = logging.getLogger(__name__)
+
 
+class TrelloObject(object):
+    # Trello objects keep their full payload, it is updated in place when
+    # changes are written
+    def __init__(self, trello, **kwargs):
+        self.trello = trello
+        self.args = kwargs
 
-class TrelloBoard(item.Item):
+    def __getattr__(self, name):
+        args = self.__dict__.get('args', {})
+        if name in args:
+            return args[name]
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.id)
+
+
+class TrelloBoard(TrelloObject):
     pass
 
 
-class TrelloList(item.Item):
+class TrelloList(TrelloObject):
     pass
 
 
-class TrelloCard(item.Item):
+class TrelloCard(TrelloObject):
     pass
 
 
-class TrelloLabel(item.Item):
+class TrelloLabel(TrelloObject):
     pass
 
 
+class TrelloSnapshot(object):
+    # In-memory model of a board, built from a single request and updated
+    # as changes are written to Trello
+    def __init__(self, trello, board_id, data):
+        self.board_id = board_id
+
+        self.labels = {}
+        self.lists = {}
+        self.cards = {}
+        self.cards_by_unique_id = {}
+
+        for li in data.get('labels', []):
+            self.add_label(TrelloLabel(trello, **li))
+        for li in data.get('lists', []):
+            self.add_list(TrelloList(trello, **li))
+        for c in data.get('cards', []):
+            # Cards loaded from the state store have their unique_id, the
+            # ones downloaded from Trello have a devboardId attachment
+            unique_id = c.get('unique_id')
+            for a in c.get('attachments', []):
+                if a['name'] == 'devboardId':
+                    unique_id = a['url'].split('/')[-1]
+
+            if unique_id:
+                self.add_card(TrelloCard(trello,
+                                         **dict(c, unique_id=unique_id)))
+
+    def add_label(self, label):
+        self.labels[label.name] = label
+
+    def add_list(self, li):
+        self.lists[li.name] = li
+        self.cards.setdefault(li.id, {})
+
+    def add_card(self, card):
+        self.cards.setdefault(card.idList, {})[card.unique_id] = card
+        self.cards_by_unique_id[card.unique_id] = card
+
+    def move_card(self, card, list_id):
+        self.cards.get(card.idList, {}).pop(card.unique_id, None)
+        card.args['idList'] = list_id
+        self.add_card(card)
+
+
+# Trello allows 100 requests per 10 seconds for each token
+RATE_LIMIT = (100, 10)
+
+_limiters = {}
+
+_report_lock = threading.Lock()
+
+
+def _limiter(token):
+    if token not in _limiters:
+        _limiters[token] = utils.RateLimiter(*RATE_LIMIT)
+    return _limiters[token]
+
+
 class Trello(object):
     name = 'trello'
     base_url = 'https://api.trello.com'
 
+    snapshot_path = ("/boards/{}?lists=open&cards=open&card_attachments=true"
+                     "&labels=all&labels_limit=1000")
+
     def __init__(self, config):
         self.config = config
 
         self.board_dict = {}
-        self.list_dict = {}
-        self.card_dict = {}
-        self.label_dict = {}
         self.list_boards = {}
+        self.snapshots = {}
+
+        # unique_id -> (item fingerprint, card state) of the cards written
+        # by devboard
+        self.pushed = {}
+
+        # All the requests are throttled to stay under the rate limit of the
+        # token, requests rejected with 429 are retried by utils
+        self.limiter = _limiter(self.config.get('auth', {}).get('token'))
+
+        # In dry runs, the operations are reported instead of written:
+        # printed when dry_run is '-', appended as JSON lines to the file
+        # dry_run otherwise
+        self.dry_run = self.config.get('dry_run')
 
     @property
     def _auth_string(self):
@@ -46,7 +145,7 @@ class Trello(object):
         url = "{}/1/members/me/boards{}".format(
             self.base_url, self._auth_string)
 
-        r = utils.get(url, ttl=10)
+        r = utils.get(url, ttl=10, limiter=self.limiter)
 
         self.board_dict = {
             b['name']: TrelloBoard(self, **b)
@@ -54,56 +153,52 @@ class Trello(object):
         }
         return self.board_dict
 
-    def _labels(self, board_id):
-        url = "{}/1/board/{}/labels{}".format(
-            self.base_url, board_id, self._auth_string)
-
-        r = utils.get(url, ttl=10)
+    def refresh(self, board=None):
+        # Drop the snapshots, the next lookup fetches the current state of
+        # the board
+        board_ids = [board.id] if board else list(self.snapshots)
+        for board_id in board_ids:
+            self.snapshots.pop(board_id, None)
+
+    def _load(self, board_id):
+        r = state.store.load(board_id)
+        if r is None:
+            return False
+        data, pushed = r
+        self.snapshots[board_id] = TrelloSnapshot(self, board_id, data)
+        for unique_id, p in pushed.items():
+            self.pushed.setdefault(unique_id, p)
+        return True
+
+    def snapshot(self, board_id):
+        # Boards are loaded from the state store, they are downloaded when
+        # they have to be reconciled
+        if board_id not in self.snapshots and not self._load(board_id):
+            params = {}
+            self._auth_params(params)
+            # The board is the state to reconcile with, it is neither read
+            # from nor written to the cache
+            url = "{}/1{}".format(self.base_url,
+                                  self.snapshot_path.format(board_id))
+            r = utils.get(url, params=params, cache=False,
+                          limiter=self.limiter)
+            self.snapshots[board_id] = TrelloSnapshot(self, board_id, r)
+            state.store.reconcile(board_id, self.snapshots[board_id],
+                                  self.pushed)
+        return self.snapshots[board_id]
 
-        self.label_dict[board_id] = {
-            li['name']: TrelloLabel(self, **li)
-            for li in r
-        }
-        return self.label_dict[board_id]
+    def _labels(self, board_id):
+        return self.snapshot(board_id).labels
 
     def _lists(self, board):
-        self._labels(board.id)
-        url = "{}/1/board/{}/lists{}".format(
-            self.base_url, board.id, self._auth_string)
-
-        r = utils.get(url, ttl=0, force=True)
-
-        self.list_dict[board.id] = {
-            li['name']: TrelloList(self, **li)
-            for li in r
-        }
-        self.list_boards = {
-            li['id']: board
-            for li in r
-        }
-        return self.list_dict[board.id]
+        lists = self.snapshot(board.id).lists
+        for li in lists.values():
+            self.list_boards[li.id] = board
+        return lists
 
     def _cards(self, list_id):
-        url = "{}/1/list/{}/cards{}&attachments=true".format(
-            self.base_url, list_id, self._auth_string)
-
-        cards = utils.get(url, ttl=10)
-
-        self.card_dict[list_id] = {}
-        for c in cards:
-            url = "{}/1/card/{}/attachments{}".format(
-                self.base_url, c['id'], self._auth_string)
-
-            unique_id = None
-            for a in c['attachments']:
-                if a['name'] == 'devboardId':
-                    unique_id = a['url'].split('/')[-1]
-
-            if unique_id:
-                self.card_dict[list_id][unique_id] = TrelloCard(
-                    self, unique_id=unique_id, **c)
-
-        return self.card_dict[list_id]
+        board = self.list_boards[list_id]
+        return self.snapshot(board.id).cards.get(list_id, {})
 
     def boards(self):
         return self._boards()
@@ -117,6 +212,11 @@ class Trello(object):
         if b:
             return b
 
+        if self.dry_run:
+            # The lists of the board are planned as if it was empty
+            LOG.info("Dry run, board {} is not created".format(board_name))
+            return TrelloBoard(self, id=None, name=board_name)
+
         params = {
             "name": board_name,
             "defaultLabels": "false",
@@ -135,16 +235,16 @@ class Trello(object):
 
         url = "{}/1/boards/".format(self.base_url)
 
-        r = utils.post(url, params=params)
+        r = utils.post(url, params=params, limiter=self.limiter)
 
         b = TrelloBoard(self, **r)
         self.board_dict[r['name']] = b
         return b
 
     def label_create(self, board_id, label_name, label_color):
-        self._labels(board_id)
-        if label_name in self.label_dict[board_id]:
-            return self.label_dict[board_id][label_name]
+        labels = self._labels(board_id)
+        if label_name in labels:
+            return labels[label_name]
 
         params = {
             "name": label_name,
@@ -156,18 +256,18 @@ class Trello(object):
 
         url = "{}/1/labels".format(self.base_url)
 
-        r = utils.post(url, params=params)
+        r = utils.post(url, params=params, limiter=self.limiter)
 
         li = TrelloLabel(self, **r)
-        self.label_dict[board_id][r['name']] = li
+        self.snapshot(board_id).add_label(li)
+        state.store.set_label(board_id, li)
         return li
 
     def lists(self, board):
         return self._lists(board)
 
     def list_get(self, board, list_name):
-        self._lists(board)
-        return self.list_dict[board.id].get(list_name)
+        return self._lists(board).get(list_name)
 
     def list_create(self, board, list_name):
         li = self.list_get(board, list_name)
@@ -182,122 +282,168 @@ class Trello(object):
 
         url = "{}/1/lists".format(self.base_url)
 
-        r = utils.post(url, params=params)
+        r = utils.post(url, params=params, limiter=self.limiter)
 
         li = TrelloList(self, **r)
-        self.list_dict[board.id][r['name']] = li
         self.list_boards[li.id] = board
+        self.snapshot(board.id).add_list(li)
+        state.store.set_list(board.id, li)
         return li
 
     def cards(self, li):
         return self._cards(li.id)
 
     def card_get(self, li, card_id):
-        self._cards(li.id)
-        cards = [
-            c
-            for c in self.card_dict[li.id].values()
-            if c.unique_id == card_id
-        ]
-        if not cards:
-            return None
-        return cards[0]
-
-    def card_delete(self, li, card_id):
-        c = self.card_get(li, card_id)
+        return self._cards(li.id).get(card_id)
 
-        board = self.list_boards[li.id]
+    def card_create(self, li, unique_id, labels=(), **fields):
+        params = dict(fields)
+        params["idList"] = li.id
+        params["idLabels"] = ','.join(label.id for label in labels)
+        self._auth_params(params)
 
-        new_list = self.list_create(board, 'Done')
+        url = "{}/1/cards".format(self.base_url)
+        r = utils.post(url, params=params, limiter=self.limiter)
+
+        c = TrelloCard(self, unique_id=unique_id, **r)
 
         params = {
-            "pos": 'top',
-            "idList": new_list.id
+            "name": "devboardId",
+            "url": "http://devboard/{}".format(unique_id)
         }
         self._auth_params(params)
 
-        url = "{}/1/cards/{}".format(self.base_url, c.id)
-        utils.put(url, params=params)
-
-    def card_set(self, li, item):
-        content = item.content[:4096]
-
-        c = self.card_get(li, item.unique_id)
-        if not c:
-            params = {
-                "name": item.summary,
-                "desc": content,
-                "pos": 'top',
-                "idList": li.id,
-            }
-            self._auth_params(params)
-
-            url = "{}/1/cards".format(self.base_url)
-            r = utils.post(url, params=params)
-
-            c = TrelloCard(self, unique_id=item.unique_id, **r)
-
-            params = {
-                "name": "devboardId",
-                "url": "http://devboard/{}".format(item.unique_id)
-            }
+        url = "{}/1/cards/{}/attachments".format(
+            self.base_url, r['id'])
+        try:
+            utils.post(url, params=params, limiter=self.limiter)
+        except Exception:
+            # Without its attachment, the card would not be recognized and
+            # would be created again on the next refresh
+            params = {}
             self._auth_params(params)
+            url = "{}/1/cards/{}".format(self.base_url, r['id'])
+            try:
+                utils.delete(url, params=params, limiter=self.limiter)
+            except Exception as e:
+                LOG.error("Cannot delete card {}: {}".format(r['id'], e))
+            raise
 
-            url = "{}/1/cards/{}/attachments".format(
-                self.base_url, r['id'])
-            r = utils.post(url, params=params)
-        else:
-            params = {}
-            if c.name != item.summary:
-                params['name'] = item.summary
-            if c.desc != content:
-                params['desc'] = content
+        board = self.list_boards[li.id]
+        self.snapshot(board.id).add_card(c)
+        return c
 
-            if params:
-                params['pos'] = 'top'
-                self._auth_params(params)
+    def card_update(self, c, li=None, labels=None, **fields):
+        # Name, description, position, list and labels are updated with a
+        # single request
+        params = dict(fields)
+        if li is not None:
+            params["idList"] = li.id
+        if labels is not None:
+            params["idLabels"] = ','.join(label.id for label in labels)
+        self._auth_params(params)
 
-                url = "{}/1/cards/{}".format(self.base_url, c.id)
-                r = utils.put(url, params=params)
+        url = "{}/1/cards/{}".format(self.base_url, c.id)
+        r = utils.put(url, params=params, limiter=self.limiter)
 
-        item_labels = []
-        for tag in item.tags:
+        for k in ('name', 'desc', 'pos', 'labels', 'idLabels'):
+            if k in r:
+                c.args[k] = r[k]
+        if li is not None and li.id != c.idList:
             board = self.list_boards[li.id]
-            label = self.label_dict[board.id].get(tag)
-            color = item.label_color(tag)
-            if not label:
-                label = self.label_create(board.id, tag, color)
-            item_labels.append(label)
-
-        items_label_ids = [
-            label.id
-            for label in item_labels
-        ]
-        current_label_ids = [
-            label['id']
-            for label in c.labels
-        ]
-
-        for label in item_labels:
-            if label.id not in current_label_ids:
-                url = "{}/1/cards/{}/idLabels".format(
-                    self.base_url, c.id)
-
-                params = {
-                    "value": label.id
-                }
-                self._auth_params(params)
-
-                r = utils.post(url, params=params)
-
-        for label in current_label_ids:
-            if label not in items_label_ids:
-                url = "{}/1/cards/{}/idLabels/{}".format(
-                    self.base_url, c.id, label)
-
-                params = {}
-                self._auth_params(params)
-
-                r = utils.delete(url, params=params)
-
+            self.snapshot(board.id).move_card(c, li.id)
         return c
+
+    def plan(self, board, list_name, items):
+        if board.id is None:
+            snapshot = TrelloSnapshot(self, None, {})
+        else:
+            self._lists(board)
+            snapshot = self.snapshot(board.id)
+        return reconcile.plan_list(snapshot, list_name, items,
+                                   pushed=self.pushed)
+
+    def report(self, board, ops):
+        ops = reconcile.coalesce(ops)
+        # A card is created with a second request for its devboardId
+        # attachment
+        requests = sum(2 if op.action == reconcile.Operation.CARD_CREATE
+                       else 1 for op in ops)
+        LOG.info("Dry run on board {}: {} operations, {} write "
+                 "requests".format(board.name, len(ops), requests))
+
+        lines = []
+        for op in ops:
+            metrics.inc('devboard_trello_operations_total',
+                        action=op.action, result='dry_run')
+            d = reconcile.describe(op)
+            if self.dry_run == '-':
+                lines.append('{}: {} {}\n'.format(
+                    board.name, d.pop('action'),
+                    ', '.join('{}={!r:.60}'.format(k, v)
+                              for k, v in sorted(d.items()))))
+            else:
+                lines.append(json.dumps(dict(d, board=board.name),
+                                        sort_keys=True) + '\n')
+
+        # Outputs are updated concurrently
+        with _report_lock:
+            if self.dry_run == '-':
+                sys.stdout.writelines(lines)
+                sys.stdout.flush()
+            else:
+                with open(self.dry_run, 'a') as fp:
+                    fp.writelines(lines)
+
+    def apply(self, board, ops):
+        # Executes the operations computed by reconcile.plan_list(). A card
+        # that cannot be written is skipped, it is written again on the next
+        # refresh.
+        if self.dry_run:
+            self.report(board, ops)
+            return
+
+        for op in reconcile.coalesce(ops):
+            params = dict(op.params)
+            if op.action == reconcile.Operation.LIST_CREATE:
+                self.list_create(board, params['name'])
+                metrics.inc('devboard_trello_operations_total',
+                            action=op.action, result='ok')
+                continue
+            if op.action == reconcile.Operation.LABEL_CREATE:
+                self.label_create(board.id, params['name'], params['color'])
+                metrics.inc('devboard_trello_operations_total',
+                            action=op.action, result='ok')
+                continue
+
+            if 'list' in params:
+                params['li'] = self.list_get(board, params.pop('list'))
+            if 'labels' in params:
+                labels = self._labels(board.id)
+                params['labels'] = [labels[name]
+                                    for name in sorted(params['labels'])]
+
+            try:
+                with metrics.timer('devboard_stage_seconds',
+                                   stage='trello_write'):
+                    if op.action == reconcile.Operation.CARD_CREATE:
+                        c = self.card_create(**params)
+                    elif op.action == reconcile.Operation.CARD_UPDATE:
+                        c = self.card_update(op.card, **params)
+            except (utils.HttpException, utils.NetworkException) as e:
+                LOG.error("Cannot apply {}: {}".format(op, e))
+                metrics.inc('devboard_trello_operations_total',
+                            action=op.action, result='error')
+                # The card may have been deleted or the state store may be
+                # outdated, the board is downloaded on the next refresh
+                state.store.invalidate(board.id)
+                continue
+            metrics.inc('devboard_trello_operations_total',
+                        action=op.action, result='ok')
+
+            fingerprint = None
+            if op.item is not None:
+                fingerprint = op.item.fingerprint
+                self.pushed[c.unique_id] = (fingerprint,
+                                            reconcile.card_state(c))
+            state.store.set_card(board.id, c, fingerprint)
@@ -1,13 +1,25 @@
-import hashlib
+import asyncio
+import collections
+import concurrent.futures
 import json
 import logging
-import os
+import queue
 import re
-import stat
+import threading
 import time
 import urllib
 
 import requests
+import requests.adapters
+
+import devboard.cache as cache
+import devboard.jsonstream as jsonstream
+import devboard.metrics as metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 
 LOG = logging.getLogger(__name__)
@@ -21,76 +33,212 @@ class NetworkException(Exception):
 
 
 class HttpException(Exception):
-    pass
-
-
-class APICache(object):
-    def __init__(self, namespace):
-        self.namespace = namespace
-        self.cache = {}
-
-        self.cache_dir = os.path.join(
-                os.environ['HOME'], '.cache',
-                namespace)
-        if not os.path.exists(self.cache_dir):
-            os.makedirs(self.cache_dir)
-
-    def get(self, h, ttl, not_before):
-        path = f'{self.cache_dir}/{h}.cache'
-        if os.path.exists(path):
-            s = os.stat(path)
-            now = time.time()
-            mtime = s[stat.ST_MTIME]
-            if not_before:
-                ref = time.mktime(not_before.timetuple())
-                if mtime < ref:
-                    return None
-            if ttl == 0 or mtime + ttl >= now:
-                with open(path) as fp:
-                    # LOG.debug(f'Reading from {path}')
-                    return json.load(fp)
-        return None
-
-    def set(self, h, data):
-        path = f'{self.cache_dir}/{h}.cache'
-        with open(path, 'w') as fp:
-            # LOG.debug(f'Writing to {path}')
-            fp.write(json.dumps(data))
-
-    def digest(self, key):
-        m = hashlib.sha256()
-        m.update(key.encode('utf-8'))
-        return m.hexdigest()
+    def __init__(self, message, status_code=None):
+        super(HttpException, self).__init__(message)
+        self.status_code = status_code
+
+
+class RateLimiter(object):
+    # Sliding window allowing at most rate requests in any period seconds
+    def __init__(self, rate, period):
+        self.rate = rate
+        self.period = period
+
+        # Times of the last rate requests
+        self.times = collections.deque(maxlen=rate)
+        self.lock = threading.Lock()
+
+    def _take(self):
+        # Takes a slot, returns the delay to wait for one if there is none
+        with self.lock:
+            now = time.monotonic()
+            if len(self.times) == self.rate:
+                delay = self.times[0] + self.period - now
+                if delay > 0:
+                    return delay
+            self.times.append(now)
+            return 0
+
+    def acquire(self):
+        delay = self._take()
+        while delay:
+            time.sleep(delay)
+            delay = self._take()
+
+    async def async_acquire(self):
+        delay = self._take()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self._take()
+
+
+DEFAULT_WORKERS = 8
+DEFAULT_HOST_CONCURRENCY = 4
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+
+def _host(url):
+    return urllib.parse.urlsplit(url).netloc
+
+
+def set_host_concurrency(url, concurrency):
+    host = _host(url)
+    with _host_slots_lock:
+        if _host_slots.get(host, (None,))[0] != concurrency:
+            _host_slots[host] = (concurrency,
+                                 threading.BoundedSemaphore(concurrency))
+
+
+def _host_slot(url):
+    host = _host(url)
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = (DEFAULT_HOST_CONCURRENCY,
+                                 threading.BoundedSemaphore(
+                                     DEFAULT_HOST_CONCURRENCY))
+        return _host_slots[host][1]
+
+
+# HTTP sessions are kept per host so connections are reused between requests
+# and between refresh cycles, pool_maxsize is the number of connections kept
+# alive per host.
+# Requests rejected with 429, or 5xx for idempotent methods, are retried up
+# to retries times with an exponential backoff starting at backoff seconds,
+# or after the delay requested by the server in Retry-After.
+http_settings = {
+    'pool_maxsize': 10,
+    'keep_alive': True,
+    'retries': 3,
+    'backoff': 1.0,
+}
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def configure_http(**settings):
+    http_settings.update(settings)
+    close()
+
+
+def _session(url):
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=http_settings['pool_maxsize'])
+            session.mount('{}://'.format(parts.scheme), adapter)
+            if not http_settings['keep_alive']:
+                session.headers['Connection'] = 'close'
+            _sessions[key] = session
+        return session
+
+
+def close():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def parallel_map(func, iterable, workers=DEFAULT_WORKERS):
+    # Like map() but calls are done in a bounded pool of threads, results
+    # are returned in the order of iterable. The number of concurrent
+    # requests to a same host is also limited in _request().
+    iterable = list(iterable)
+    if len(iterable) <= 1 or workers <= 1:
+        return [func(e) for e in iterable]
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(workers, len(iterable))) as executor:
+        return list(executor.map(metrics.profiler.wrap(func), iterable))
+
+
+def parallel_chain(iterables, workers=DEFAULT_WORKERS, buffer_size=256):
+    # Consumes the iterables in a bounded pool of threads and yields their
+    # elements as soon as they are produced, in no particular order. The
+    # buffer between the threads and the caller is bounded, producers wait
+    # for the caller to catch up. An exception raised by an iterable is
+    # raised in the caller.
+    iterables = list(iterables)
+    if not iterables:
+        return
+
+    done = object()
+    results = queue.Queue(maxsize=buffer_size)
+    stop = threading.Event()
+
+    def put(e):
+        while not stop.is_set():
+            try:
+                results.put(e, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def consume(iterable):
+        try:
+            for e in iterable:
+                if not put((e, None)):
+                    return
+        except Exception as exc:
+            put((done, exc))
+        else:
+            put((done, None))
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(workers, len(iterables))) as executor:
+        for iterable in iterables:
+            executor.submit(metrics.profiler.wrap(consume), iterable)
+
+        remaining = len(iterables)
+        try:
+            while remaining:
+                e, exc = results.get()
+                if e is done:
+                    if exc:
+                        raise exc
+                    remaining -= 1
+                    continue
+                yield e
+        finally:
+            stop.set()
+
+
+def _check_response(r):
+    if r.status_code >= 400:
+        raise HttpException("Response code {}: {}".format(
+            r.status_code, r.text.split('\n', 1)[0:10]),
+            status_code=r.status_code)
 
-    def __call__(self, func):
-        def wrapper(url, ttl=3600, not_before=None, force=False, **kwargs):
-            key = "{}#{}".format(
-                url,
-                urllib.parse.urlencode(kwargs.get('params', {})))
-            h = self.digest(key)
 
-            if not force:
-                c = self.get(h, ttl, not_before)
-                if c is not None:
-                    return c
+def _is_json(r):
+    return r.headers.get('Content-Type', '').startswith('application/json')
 
-            r = func(url, **kwargs)
-            self.set(h, r)
 
-            return r
-        return wrapper
+def _decode(r):
+    # Returns the decoded response and, for JSON, the JSON document without
+    # XSSI prefix
+    _check_response(r)
+    if _is_json(r):
+        raw = r.content
+        if raw.startswith(jsonstream.XSSI_PREFIX):
+            raw = raw[raw.find(b'\n') + 1:]
+        with metrics.timer('devboard_stage_seconds', stage='json_decode'):
+            return json.loads(raw), raw
+    return r.text, None
 
 
 def _handle_response(r):
-    if r.status_code >= 400:
-        raise HttpException("Response code {}: {}".format(
-            r.status_code, r.text.split('\n', 1)[0:10]))
-    if r.headers.get('Content-Type').startswith('application/json'):
-        if r.text.startswith(')]}'):
-            data = r.text.split('\n', 1)[1]
-            return json.loads(data)
-        return r.json()
-    return r.text
+    return _decode(r)[0]
 
 
 def _clean_url(url):
@@ -98,26 +246,192 @@ def _clean_url(url):
     return url
 
 
-def _request(method, url, **kwargs):
-    LOG.debug("{} {}".format(method,
-                             _clean_url(url)))
-
-    func = getattr(requests, method.lower())
+def _retry_delay(r, attempt):
     try:
-        r = func(url, **kwargs)
-    except requests.exceptions.ConnectionError as e:
-        LOG.error("Error while requesting {} {}: {}".format(
-            method, _clean_url(url), e))
-        raise NetworkException("Cannot connect to remote server")
-
+        return float(r.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return http_settings['backoff'] * 2 ** attempt
+
+
+def _observe_request(method, url, status, start):
+    # With stream=True, the time to receive the headers
+    elapsed = time.perf_counter() - start
+    host = _host(url)
+    metrics.observe('devboard_http_request_seconds', elapsed,
+                    host=host, method=method)
+    metrics.observe('devboard_stage_seconds', elapsed, stage='http')
+    metrics.inc('devboard_http_requests_total',
+                host=host, method=method, status=status)
+
+
+def _connection_error(method, url, e, start):
+    # Connection errors of both the requests and the aiohttp requests
+    LOG.error("Error while requesting {} {}: {}".format(
+        method, _clean_url(url), e))
+    _observe_request(method, url, 'error', start)
+    return NetworkException("Cannot connect to remote server")
+
+
+def _next_attempt(method, url, r, start, attempt, retries):
+    # Records the response of an attempt, returns the delay before the next
+    # attempt or None when the response is final. Shared by _send() and
+    # _async_send() so they retry the same responses.
     LOG.debug("returns {}".format(r.status_code))
+    _observe_request(method, url, r.status_code, start)
 
-    return _handle_response(r)
+    if attempt >= retries or not (
+            r.status_code == 429 or
+            (r.status_code >= 500 and method in IDEMPOTENT_METHODS)):
+        return None
+    delay = _retry_delay(r, attempt)
+    LOG.warning("{} {} returned {}, retrying in {:.1f}s".format(
+        method, _clean_url(url), r.status_code, delay))
+    return delay
+
+
+def _send(method, url, limiter=None, retries=None, **kwargs):
+    if retries is None:
+        retries = http_settings['retries']
+
+    func = getattr(_session(url), method.lower())
+    attempt = 0
+    while True:
+        if limiter:
+            limiter.acquire()
+
+        LOG.debug("{} {}".format(method,
+                                 _clean_url(url)))
+        try:
+            with _host_slot(url):
+                start = time.perf_counter()
+                r = func(url, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            raise _connection_error(method, url, e, start)
+
+        delay = _next_attempt(method, url, r, start, attempt, retries)
+        if delay is None:
+            return r
+        r.close()
+        time.sleep(delay)
+        attempt += 1
 
 
-@APICache('devboard')
-def get(url, **kwargs):
-    return _request('GET', url, **kwargs)
+def _request(method, url, **kwargs):
+    return _handle_response(_send(method, url, **kwargs))
+
+
+def _conditional_headers(headers, validators):
+    headers = dict(headers or {})
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def _validators(r):
+    validators = {
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+    }
+    return {k: v
+            for k, v in validators.items()
+            if v}
+
+
+@cache.APICache('devboard')
+def get(url, validators=None, headers=None, **kwargs):
+    # Conditional GET, returns (data, validators, raw JSON), data is
+    # NOT_MODIFIED if the response matching validators is still valid
+    r = _send('GET', url,
+              headers=_conditional_headers(headers, validators), **kwargs)
+    if r.status_code == 304:
+        LOG.debug("{} not modified".format(_clean_url(url)))
+        return cache.NOT_MODIFIED, validators, None
+
+    data, raw = _decode(r)
+    return data, _validators(r), raw
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _walk(data, path):
+    for key in path:
+        data = data[key]
+    return data or []
+
+
+def iter_json(url, path=(), ttl=3600, not_before=None, force=False,
+              cache=True, headers=None, **kwargs):
+    # Like get() for a JSON document, but yields the elements of the array
+    # at path (see jsonstream.iter_array) as they are received. The response
+    # is written as is to the cache while it is parsed, responses smaller
+    # than the stream_bytes setting of the cache are also kept decoded in
+    # memory.
+    api_cache = get.cache
+    h = api_cache.key(url, kwargs.get('params'))
+
+    if cache and not force:
+        data, fp = api_cache.open(h, ttl, not_before)
+        if data is not None:
+            yield from _walk(data, path)
+            return
+        if fp is not None:
+            with fp:
+                yield from jsonstream.iter_array(
+                    iter(lambda: fp.read(STREAM_CHUNK_SIZE), b''), path)
+            return
+
+    validators = api_cache.validators(h) if cache else None
+    r = _send('GET', url, headers=_conditional_headers(headers, validators),
+              stream=True, **kwargs)
+    if r.status_code == 304:
+        r.close()
+        if api_cache.touch(h):
+            LOG.debug("{} not modified".format(_clean_url(url)))
+            yield from iter_json(url, path, ttl=0, headers=headers, **kwargs)
+            return
+        # Entry removed in the meantime, the response is requested again
+        # without validators
+        r = _send('GET', url, headers=_conditional_headers(headers, None),
+                  stream=True, **kwargs)
+    with r:
+        _check_response(r)
+
+        chunks = jsonstream.skip_xssi_prefix(
+            r.iter_content(STREAM_CHUNK_SIZE))
+        if not cache:
+            yield from jsonstream.iter_array(chunks, path)
+            return
+
+        writer = api_cache.writer(h, _validators(r))
+        buffered = []
+        try:
+            def tee():
+                nonlocal buffered
+                for chunk in chunks:
+                    writer.write(chunk)
+                    if buffered is not None:
+                        if writer.size > api_cache.settings['stream_bytes']:
+                            buffered = None
+                        else:
+                            buffered.append(chunk)
+                    yield chunk
+
+            stored = tee()
+            yield from jsonstream.iter_array(stored, path)
+            # Store the rest of the document
+            for chunk in stored:
+                pass
+        except BaseException:
+            writer.abort()
+            raise
+        data = None
+        if buffered is not None:
+            data = json.loads(b''.join(buffered))
+        writer.commit(data)
 
 
 def post(url, **kwargs):
@@ -130,3 +444,179 @@ def put(url, **kwargs):
 
 def delete(url, **kwargs):
     return _request('DELETE', url, **kwargs)
+
+
+# Async variants of get(), post(), put() and delete(), for sources and
+# outputs running in the asyncio engine. Requests are done with aiohttp when
+# it is installed, the blocking functions are run in threads otherwise.
+# They share the cache, the retry settings and the per-host concurrency
+# limits of the blocking functions.
+
+async def run_sync(func, *args, **kwargs):
+    # Runs a blocking call in a daemon thread, so a hung call cannot prevent
+    # devboard from exiting
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def resolve(result, exc):
+        if future.cancelled():
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    func = metrics.profiler.wrap(func)
+
+    def target():
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            loop.call_soon_threadsafe(resolve, None, e)
+        else:
+            loop.call_soon_threadsafe(resolve, result, None)
+
+    threading.Thread(target=target, daemon=True,
+                     name='run-sync-{}'.format(
+                         getattr(func, '__name__', 'func'))).start()
+    return await future
+
+
+class _AsyncResponse(object):
+    # The parts of a requests.Response used by the response helpers
+    def __init__(self, status_code, headers, content, encoding):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+
+_async_sessions = {}
+_async_host_slots = {}
+
+
+def _async_session(url):
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    session = _async_sessions.get(key)
+    if session is None:
+        connector = aiohttp.TCPConnector(
+            limit_per_host=http_settings['pool_maxsize'],
+            force_close=not http_settings['keep_alive'])
+        session = aiohttp.ClientSession(connector=connector)
+        _async_sessions[key] = session
+    return session
+
+
+def _async_host_slot(url):
+    host = _host(url)
+    concurrency = _host_slots.get(host, (DEFAULT_HOST_CONCURRENCY,))[0]
+    if _async_host_slots.get(host, (None,))[0] != concurrency:
+        _async_host_slots[host] = (concurrency,
+                                   asyncio.Semaphore(concurrency))
+    return _async_host_slots[host][1]
+
+
+async def async_close():
+    for session in _async_sessions.values():
+        await session.close()
+    _async_sessions.clear()
+    _async_host_slots.clear()
+
+
+def _aiohttp_params(params):
+    # requests drops None values and repeats the keys of list values
+    ret = []
+    for k, v in (params or {}).items():
+        for e in (v if isinstance(v, (list, tuple)) else [v]):
+            if e is not None:
+                ret.append((k, e if isinstance(e, str) else str(e)))
+    return ret
+
+
+async def _async_send(method, url, limiter=None, retries=None, auth=None,
+                      verify=True, params=None, **kwargs):
+    if retries is None:
+        retries = http_settings['retries']
+    if auth is not None:
+        auth = aiohttp.BasicAuth(*auth)
+    params = _aiohttp_params(params)
+
+    session = _async_session(url)
+    attempt = 0
+    while True:
+        if limiter:
+            await limiter.async_acquire()
+
+        LOG.debug("{} {}".format(method,
+                                 _clean_url(url)))
+        try:
+            async with _async_host_slot(url):
+                start = time.perf_counter()
+                async with session.request(method, url, auth=auth,
+                                           ssl=None if verify else False,
+                                           params=params, **kwargs) as r:
+                    response = _AsyncResponse(r.status, r.headers,
+                                              await r.read(), r.charset)
+        except aiohttp.ClientConnectionError as e:
+            raise _connection_error(method, url, e, start)
+
+        delay = _next_attempt(method, url, response, start, attempt, retries)
+        if delay is None:
+            return response
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def async_get(url, ttl=3600, not_before=None, force=False, cache=True,
+                    headers=None, **kwargs):
+    if aiohttp is None:
+        return await run_sync(get, url, ttl=ttl, not_before=not_before,
+                              force=force, cache=cache, headers=headers,
+                              **kwargs)
+
+    # Cache lookups are local, they are done in the event loop
+    api_cache = get.cache
+    h = api_cache.key(url, kwargs.get('params'))
+    if cache and not force:
+        data = api_cache.get(h, ttl, not_before)
+        if data is not None:
+            return data
+
+    validators = api_cache.validators(h) if cache else None
+    r = await _async_send('GET', url,
+                          headers=_conditional_headers(headers, validators),
+                          **kwargs)
+    if r.status_code == 304:
+        LOG.debug("{} not modified".format(_clean_url(url)))
+        data = api_cache.refresh(h)
+        if data is not None:
+            return data
+        r = await _async_send('GET', url, headers=headers, **kwargs)
+
+    data, raw = _decode(r)
+    if cache:
+        api_cache.set(h, data, _validators(r), raw=raw)
+    return data
+
+
+async def _async_request(method, url, **kwargs):
+    if aiohttp is None:
+        return await run_sync(_request, method, url, **kwargs)
+    return _handle_response(await _async_send(method, url, **kwargs))
+
+
+async def async_post(url, **kwargs):
+    return await _async_request('POST', url, **kwargs)
+
+
+async def async_put(url, **kwargs):
+    return await _async_request('PUT', url, **kwargs)
+
+
+async def async_delete(url, **kwargs):
+    return await _async_request('DELETE', url, **kwargs)